@@ -2,23 +2,41 @@
 
 __license__ = 'MIT'
 import argparse
+import contextlib
 import json
 import os
 import shutil
 import subprocess
 import sys
-
+import threading
+import time
+import traceback
+
+from batch_history import batch_history
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from converter.converter import __version__
+from datetime import datetime, timezone
+from download_cache.download_cache import prefetch
+from fingerprint.fingerprint import get_fingerprint, hash_files
+from manifest_sources.manifest_sources import get_local_files, get_remote_sources
 from pathlib import Path
-
-version = __import__("flatpak-flutter").__version__
+from typing import Optional, TextIO
 
 
-def run(script: bool, command: list[str]) -> int:
+def run(script: bool, command: list[str], cwd: Optional[str] = None, log: Optional[TextIO] = None) -> int:
     if script:
         print(' '.join(command))
         return 0
     else:
-        return subprocess.run(command).returncode
+        if log is not None:
+            log.write(f'$ {" ".join(command)}\n')
+            log.flush()
+
+        try:
+            return subprocess.run(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT if log else None).returncode
+        except OSError as error:
+            print(f'Error: {error}', file=log)
+            return 127
 
 
 def chdir(script: bool, path: str):
@@ -57,13 +75,14 @@ def prepare(root: str, name: str, clean: bool, script: bool):
         remote = True
         makedirs(script, path)
 
-    chdir(script, path)
+    if script:
+        chdir(script, path)
 
     return remote
 
 
-def preprocess(flatpak_flutter_root: str, app, remote: bool, script: bool):
-        print(f'\n\n# === Preprocessing: {app["name"]} ===\n')
+def preprocess(flatpak_flutter_root: str, app, remote: bool, script: bool, cwd: Optional[str] = None, log: Optional[TextIO] = None, profile: Optional[str] = None):
+        print(f'\n\n# === Preprocessing: {app["name"]} ===\n', file=log)
 
         prepro = [
             f'{flatpak_flutter_root}/flatpak-flutter.py',
@@ -80,16 +99,27 @@ def preprocess(flatpak_flutter_root: str, app, remote: bool, script: bool):
         if 'options' in app:
             prepro += app['options']
 
-        return run(script, prepro)
+        if profile:
+            prepro.append(f'--profile={profile}')
+
+        return run(script, prepro, cwd, log)
 
 
-def build(name: str, suffix: str, script: bool, install: bool):
-    print(f'\n\n# === Building: {name} ===\n')
+def build(
+    name: str,
+    suffix: str,
+    script: bool,
+    install: bool,
+    cwd: Optional[str] = None,
+    log: Optional[TextIO] = None,
+    state_dir: Optional[str] = None,
+    extra_sources: Optional[str] = None,
+    export_lock: Optional[threading.Lock] = None,
+):
+    print(f'\n\n# === Building: {name} ===\n', file=log)
 
     build = [
         'flatpak-builder',
-        '--repo',
-        '../repo',
         '--force-clean',
         '--sandbox',
         '--install-deps-from',
@@ -97,23 +127,221 @@ def build(name: str, suffix: str, script: bool, install: bool):
         'build',
         f'{name}{suffix}',
     ]
+    export = [
+        'flatpak-builder',
+        '--export-only',
+        '--repo',
+        '../repo',
+        'build',
+        f'{name}{suffix}',
+    ]
 
     if install:
-        index = build.index('build')
-        build.insert(index, '--user')
-        build.insert(index, '--install')
+        index = export.index('build')
+        export.insert(index, '--user')
+        export.insert(index, '--install')
+
+    if state_dir:
+        build.insert(build.index('build'), f'--state-dir={state_dir}')
+        export.insert(export.index('build'), f'--state-dir={state_dir}')
+
+    if extra_sources:
+        build.insert(build.index('build'), f'--extra-sources={extra_sources}')
+
+    return_code = run(script, build, cwd, log)
+
+    if return_code:
+        return return_code
+
+    # Builds run concurrently, the exports to the shared repo one at a time
+    with export_lock if export_lock is not None else contextlib.nullcontext():
+        return run(script, export, cwd, log)
+
+
+class BuildBudget:
+    def __init__(self, jobs: int, min_free_gb: float, root: str):
+        self._jobs = max(1, jobs)
+        self._min_free = min_free_gb * 1024 ** 3
+        self._root = root
+        self._running = 0
+        self._condition = threading.Condition()
+
+    def _has_disk_space(self) -> bool:
+        return shutil.disk_usage(self._root).free >= self._min_free
+
+    @contextlib.contextmanager
+    def acquire(self):
+        with self._condition:
+            # A build only starts on low disk space when no other build is running
+            while self._running >= self._jobs or (self._running and not self._has_disk_space()):
+                self._condition.wait(timeout=60)
+
+            self._running += 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._running -= 1
+                self._condition.notify_all()
+
+
+class BuildState:
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._apps = {}
+
+        if os.path.isfile(path):
+            with open(path, 'r') as input:
+                self._apps = json.load(input)
+
+    def is_unchanged(self, name: str, digest: Optional[str]) -> bool:
+        with self._lock:
+            state = self._apps.get(name, {})
+
+        return digest is not None and state.get('digest') == digest and state.get('succeeded', False)
+
+    def record(self, name: str, digest: Optional[str], succeeded: bool):
+        with self._lock:
+            self._apps[name] = {'digest': digest, 'succeeded': succeeded}
+
+            with open(self._path, 'w') as output:
+                json.dump(self._apps, output, indent=4)
+
+
+def get_digest(root: str, app, install: bool) -> Optional[str]:
+    path = f'{root}/{app["name"]}'
+    manifest = f'{path}/{app["name"]}{app["suffix"]}'
+
+    if not os.path.isfile(manifest):
+        return None
 
-    return run(script, build)
+    hashes = hash_files(get_local_files(manifest))
+
+    return get_fingerprint({
+        'app': app,
+        'install': install,
+        'files': {os.path.relpath(file, path): sha256 for file, sha256 in hashes.items()},
+    })
+
+
+def _get_downloaded_bytes(profile: str) -> int:
+    try:
+        with open(profile, 'r') as input:
+            return json.load(input).get('bytes', 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def preprocess_app(flatpak_flutter_root: str, root: str, app, args, entry: dict) -> tuple[str, Optional[str], int]:
+    name = app['name']
+    remote = prepare(root, name, args.clean, False)
+    profile = f'{root}/logs/{name}.profile.json'
+    os.makedirs(f'{root}/logs', exist_ok=True)
+
+    with open(f'{root}/logs/{name}.log', 'w') as log:
+        print(f'[{name}] Preprocessing...')
+        start = time.perf_counter()
+        return_code = preprocess(flatpak_flutter_root, app, remote, False, f'{root}/{name}', log, profile)
+        entry['preprocess'] = time.perf_counter() - start
+        entry['preprocess_rc'] = return_code
+        entry['bytes'] = _get_downloaded_bytes(profile)
+
+    return name, 'flatpak-flutter' if return_code else None, return_code
+
+
+def build_app(
+    root: str,
+    app,
+    args,
+    budget: BuildBudget,
+    state_dir: Optional[str],
+    state: BuildState,
+    entry: dict,
+    export_lock: threading.Lock,
+) -> tuple[str, Optional[str], int]:
+    name = app['name']
+    digest = get_digest(root, app, args.install)
+    forced = args.force is not None and (not args.force or name in args.force)
+
+    if not forced and state.is_unchanged(name, digest):
+        print(f'[{name}] Unchanged since the last successful build, skipping')
+        entry['skipped'] = True
+        return name, None, 0
+
+    with open(f'{root}/logs/{name}.log', 'a') as log, budget.acquire():
+        print(f'[{name}] Building...')
+        start = time.perf_counter()
+        if state_dir and args.build_jobs > 1:
+            # Concurrent builds don't share a state dir, the shared one only provides the downloads
+            return_code = build(name, app['suffix'], False, args.install, f'{root}/{name}', log, f'{state_dir}/builds/{name}', state_dir, export_lock)
+        else:
+            return_code = build(name, app['suffix'], False, args.install, f'{root}/{name}', log, state_dir, None, export_lock)
+        entry['build'] = time.perf_counter() - start
+        entry['build_rc'] = return_code
+
+    state.record(name, digest, return_code == 0)
+
+    if return_code:
+        return name, 'flatpak-builder', return_code
+
+    print(f'[{name}] Done')
+
+    return name, None, 0
+
+
+def get_result(root: str, name: str, future: Future) -> tuple[str, Optional[str], int]:
+    # An unexpected error only fails its own app, the batch carries on
+    try:
+        return future.result()
+    except Exception as error:
+        print(f'[{name}] Failed: {error}', file=sys.stderr)
+
+        try:
+            os.makedirs(f'{root}/logs', exist_ok=True)
+
+            with open(f'{root}/logs/{name}.log', 'a') as log:
+                log.write(traceback.format_exc())
+        except OSError:
+            pass
+
+        return name, 'batch-build', 1
+
+
+def prefetch_apps(root: str, apps: list, state_dir: str, jobs: int) -> dict:
+    sources = []
+
+    for app in apps:
+        manifest = f'{root}/{app["name"]}/{app["name"]}{app["suffix"]}'
+
+        if os.path.isfile(manifest):
+            sources += [(source['url'], source['sha256']) for source in get_remote_sources(manifest)]
+
+    print(f'\n# === Prefetching {len(set(sources))} unique sources of {len(apps)} applications ===\n')
+    result = prefetch(sources, state_dir, jobs)
+    print(f'{result.cached} cached, {result.downloaded} downloaded ({result.bytes} bytes), {len(result.failures)} failed')
+
+    return {'cached': result.cached, 'downloaded': result.downloaded, 'bytes': result.bytes, 'failures': len(result.failures)}
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('APPS_JSON', help='Path to the apps.json file')
-    parser.add_argument('-V', '--version', action='version', version=f'%(prog)s-{version}')
+    parser.add_argument('-V', '--version', action='version', version=f'%(prog)s-{__version__}')
     parser.add_argument('-y', '--yes', action='store_true', help="Answer all questions with yes")
     parser.add_argument('-c', '--clean', action='store_true', help="Perform clean flatpak-builder builds")
     parser.add_argument('-i', '--install', action='store_true', help="Perform (user) install after build")
     parser.add_argument('-s', '--script', action='store_true', help="Script the commands instead of executing")
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1, help="Number of apps to preprocess concurrently")
+    parser.add_argument('--build-jobs', metavar='N', type=int, default=1, help="Number of apps to build concurrently")
+    parser.add_argument('--prefetch', action='store_true', help="Download the sources of all apps once, into a shared state dir")
+    parser.add_argument('--state-dir', metavar='DIR', help="flatpak-builder state dir shared by all builds, concurrent builds only share its downloads")
+    parser.add_argument('--force', metavar='APP', nargs='*', help="Build the given apps, or all apps, even when unchanged since their last successful build")
+    parser.add_argument('--min-free-space', metavar='GB', type=float, default=0, help="Free disk space needed to start an additional build")
+    parser.add_argument('--history', metavar='N', type=int, default=5, help="Number of previous runs to compare the timings with")
+    parser.add_argument('--threshold', metavar='PCT', type=float, default=20, help="Percentage above the previous timings that counts as a regression")
+    parser.add_argument('--export', metavar='FILE', help="Export the timing history as JSON, or as CSV when FILE ends with .csv")
 
     args = parser.parse_args()
     apps_json = args.APPS_JSON
@@ -144,21 +372,77 @@ def main():
     if not args.script and not args.yes and input('Continue (y/N)? ') != 'y':
         exit(1)
 
-    for app in apps:
-        remote = prepare(root, app['name'], args.clean, args.script)
-        return_code = preprocess(flatpak_flutter_root, app, remote, args.script)
+    if args.script:
+        for app in apps:
+            remote = prepare(root, app['name'], args.clean, args.script)
+            preprocess(flatpak_flutter_root, app, remote, args.script)
+            build(app['name'], app['suffix'], args.script, args.install)
+            chdir(args.script, '..')
+
+        return
+
+    budget = BuildBudget(args.build_jobs, args.min_free_space, str(root))
+    state = BuildState(f'{root}/.batch-build.json')
+    state_dir = os.path.abspath(args.state_dir) if args.state_dir else f'{root}/.flatpak-builder' if args.prefetch else None
+    history_path = f'{root}/.batch-history.json'
+    history = batch_history.load(history_path)
+    batch_run = {'started': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'apps': {app['name']: {} for app in apps}}
+
+    export_lock = threading.Lock()
+
+    # Builds run on their own executor, waiting for a build slot doesn't hold up preprocessing
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as preprocess_executor, \
+            ThreadPoolExecutor(max_workers=max(1, args.build_jobs)) as build_executor:
+        preprocess_futures = {
+            preprocess_executor.submit(preprocess_app, flatpak_flutter_root, root, app, args, batch_run['apps'][app['name']]): app
+            for app in apps
+        }
+        outcomes = {}
+
+        def submit_build(app, result):
+            if result[1] is None:
+                outcomes[app['name']] = build_executor.submit(build_app, root, app, args, budget, state_dir, state, batch_run['apps'][app['name']], export_lock)
+            else:
+                outcomes[app['name']] = result
+
+        if args.prefetch:
+            # All manifests are needed up front, to fetch the union of their sources
+            preprocessed = [(app, get_result(root, app['name'], future)) for future, app in preprocess_futures.items()]
+            batch_run['prefetch'] = prefetch_apps(root, [app for app, result in preprocessed if result[1] is None], state_dir, args.jobs)
+
+            for app, result in preprocessed:
+                submit_build(app, result)
+        else:
+            for future in as_completed(preprocess_futures):
+                app = preprocess_futures[future]
+                submit_build(app, get_result(root, app['name'], future))
 
-        if return_code:
-            print(f'Error: flatpak-flutter failed with return code {return_code}')
-            exit(1)
+        results = [
+            get_result(root, app['name'], outcomes[app['name']]) if isinstance(outcomes[app['name']], Future) else outcomes[app['name']]
+            for app in apps
+        ]
 
-        return_code = build(app['name'], app['suffix'], args.script, args.install)
+    print('\n# === Summary ===\n')
+    failures = 0
 
-        if return_code:
-            print(f'Error: flatpak-builder failed with return code {return_code}')
-            exit(1)
+    for name, failed, return_code in results:
+        if failed:
+            failures += 1
+            print(f'FAIL {name}: {failed} failed with return code {return_code}, see {root}/logs/{name}.log')
+        else:
+            print(f'PASS {name}')
 
-        chdir(args.script, '..')
+    print(f'\n{len(results) - failures} passed, {failures} failed')
+
+    batch_history.print_report(batch_run, history[-args.history:] if args.history > 0 else [], args.threshold)
+    history.append(batch_run)
+    batch_history.save(history_path, history)
+
+    if args.export:
+        batch_history.export(args.export, history)
+
+    if failures:
+        exit(1)
 
 
 if __name__ == '__main__':
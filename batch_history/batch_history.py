@@ -0,0 +1,103 @@
+__license__ = 'MIT'
+import csv
+import json
+import os
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+FIELDS = ['preprocess', 'build', 'bytes', 'preprocess_rc', 'build_rc', 'skipped']
+TIMINGS = ['preprocess', 'build']
+# Differences below this number of seconds are considered noise
+MIN_REGRESSION = 1.0
+
+
+def load(path: str) -> List[Dict[str, Any]]:
+    if not os.path.isfile(path):
+        return []
+
+    with open(path, 'r') as input:
+        return json.load(input)
+
+
+def save(path: str, runs: List[Dict[str, Any]]):
+    with open(f'{path}.{os.getpid()}', 'w') as output:
+        json.dump(runs, output, indent=4)
+
+    os.replace(f'{path}.{os.getpid()}', path)
+
+
+def _get_baseline(previous: List[Dict[str, Any]], name: str, timing: str) -> Optional[float]:
+    values = [
+        run['apps'][name][timing] for run in previous
+        if name in run['apps'] and run['apps'][name].get(timing) is not None and not run['apps'][name].get('skipped')
+    ]
+
+    return sum(values) / len(values) if values else None
+
+
+def get_regressions(run: Dict[str, Any], previous: List[Dict[str, Any]], threshold: float) -> List[str]:
+    regressions = []
+
+    for name, entry in run['apps'].items():
+        for timing in TIMINGS:
+            baseline = _get_baseline(previous, name, timing)
+            value = entry.get(timing)
+
+            if baseline is None or value is None or entry.get('skipped'):
+                continue
+
+            if value - baseline >= MIN_REGRESSION and value > baseline * (1 + threshold / 100):
+                regressions.append(f'{name}: {timing} took {value:.1f}s, {(value / baseline - 1) * 100:.0f}% above the average of {baseline:.1f}s')
+
+    return regressions
+
+
+def _format(value: Optional[float], baseline: Optional[float]) -> str:
+    if value is None:
+        return '-'
+
+    if baseline is None or baseline == 0:
+        return f'{value:.1f}s'
+
+    return f'{value:.1f}s ({(value / baseline - 1) * 100:+.0f}%)'
+
+
+def print_report(run: Dict[str, Any], previous: List[Dict[str, Any]], threshold: float):
+    print(f'\n# === Timings, compared to the average of the previous {len(previous)} runs ===\n')
+    rows = [['App', 'Preprocess', 'Build', 'Downloaded']]
+
+    for name, entry in run['apps'].items():
+        rows.append([
+            name,
+            _format(entry.get('preprocess'), _get_baseline(previous, name, 'preprocess')),
+            'skipped' if entry.get('skipped') else _format(entry.get('build'), _get_baseline(previous, name, 'build')),
+            f'{entry.get("bytes", 0)} bytes',
+        ])
+
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+    regressions = get_regressions(run, previous, threshold)
+
+    if regressions:
+        print(f'\nRegressions beyond {threshold:g}%:')
+
+        for regression in regressions:
+            print(f'  {regression}')
+
+
+def export(path: str, runs: List[Dict[str, Any]]):
+    if Path(path).suffix == '.csv':
+        with open(path, 'w', newline='') as output:
+            writer = csv.writer(output)
+            writer.writerow(['started', 'app'] + FIELDS)
+
+            for run in runs:
+                for name, entry in run['apps'].items():
+                    writer.writerow([run['started'], name] + [entry.get(field) for field in FIELDS])
+    else:
+        with open(path, 'w') as output:
+            json.dump(runs, output, indent=4)
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+
+__license__ = 'MIT'
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import yaml
+
+from cargo_generator.cargo_generator import generate_sources as generate_cargo_sources
+from converter import converter
+from flutter_app_fetcher.flutter_app_fetcher import Dumper
+from pubspec_generator.pubspec_generator import generate_sources as generate_pubspec_sources
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+APP = 'app'
+# The fixtures' git dependencies are cloned from local repos, which stand in for this host
+GIT_HOST = 'https://git.benchmark.invalid'
+GIT = ['git', '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@localhost', '-c', 'init.defaultBranch=main']
+
+
+class Benchmark(NamedTuple):
+    name: str
+    run: Callable[[], Any]
+    setup: Optional[Callable[[], None]] = None
+
+
+def _checksum(*parts) -> str:
+    return hashlib.sha256('-'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def _write_pubspec_lock(path: str, packages: Dict[str, Any]):
+    os.makedirs(path, exist_ok=True)
+
+    with open(f'{path}/pubspec.lock', 'w') as output:
+        yaml.dump({'packages': packages, 'sdks': {'dart': '>=3.5.0 <4.0.0'}}, output, sort_keys=True)
+
+
+def _hosted_package(name: str, version: str) -> Dict[str, Any]:
+    return {
+        'dependency': 'transitive',
+        'description': {'name': name, 'sha256': _checksum(name, version), 'url': 'https://pub.dev'},
+        'source': 'hosted',
+        'version': version,
+    }
+
+
+def create_pubspec_locks(workdir: str, count: int, foreign_deps_json: str) -> List[str]:
+    packages = {}
+
+    with open(foreign_deps_json, 'r') as input:
+        foreign_deps = json.load(input)
+
+    # Every known foreign dependency is in use, to exercise the index lookups
+    for name, versions in foreign_deps.items():
+        packages[name] = _hosted_package(name, list(versions)[-1])
+
+    for idx in range(count - len(packages)):
+        name = f'package_{idx:05}'
+
+        if idx % 50 == 0:
+            packages[name] = {
+                'dependency': 'transitive',
+                'description': {
+                    'path': '.',
+                    'ref': 'main',
+                    'resolved-ref': _checksum(name)[:40],
+                    'url': f'https://github.com/example/{name}.git',
+                },
+                'source': 'git',
+                'version': '1.0.0',
+            }
+        else:
+            packages[name] = _hosted_package(name, f'{idx % 7}.{idx % 13}.{idx % 5}')
+
+    _write_pubspec_lock(f'{workdir}/{APP}', packages)
+
+    # The flutter_tools lock overlaps with the app lock, like it does in practice
+    tools = {name: package for idx, (name, package) in enumerate(packages.items()) if idx % 10 == 0}
+    _write_pubspec_lock(f'{workdir}/{APP}/flutter_tools', tools)
+
+    return [f'{workdir}/{APP}/pubspec.lock', f'{workdir}/{APP}/flutter_tools/pubspec.lock']
+
+
+def _create_git_workspace(path: str, crates: int) -> str:
+    work = f'{path}.work'
+    members = [f'crate_{os.path.basename(path)}_{idx:04}' for idx in range(crates)]
+
+    os.makedirs(work)
+
+    with open(f'{work}/Cargo.toml', 'w') as output:
+        output.write('[workspace]\nmembers = ["crates/*"]\n\n[workspace.package]\nversion = "0.1.0"\nedition = "2021"\n\n')
+        output.write('[workspace.dependencies]\nserde = { version = "1.0", features = ["derive"] }\n')
+
+    for member in members:
+        os.makedirs(f'{work}/crates/{member}/src')
+
+        with open(f'{work}/crates/{member}/Cargo.toml', 'w') as output:
+            output.write(f'[package]\nname = "{member}"\nversion.workspace = true\nedition.workspace = true\n\n')
+            output.write('[dependencies]\nserde = { workspace = true, features = ["std"] }\n')
+
+        with open(f'{work}/crates/{member}/src/lib.rs', 'w') as output:
+            output.write('\n')
+
+    subprocess.run(GIT + ['init', '-q', work], check=True)
+    subprocess.run(GIT + ['add', '.'], cwd=work, check=True)
+    subprocess.run(GIT + ['commit', '-q', '-m', 'Workspace'], cwd=work, check=True)
+    subprocess.run(GIT + ['clone', '-q', '--bare', work, path], check=True)
+    shutil.rmtree(work)
+
+    result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=path, stdout=subprocess.PIPE, check=True)
+
+    return result.stdout.decode('utf-8').strip()
+
+
+def create_cargo_lock(workdir: str, count: int, repos: int, workspace_crates: int) -> str:
+    packages = []
+
+    for repo in range(repos):
+        path = f'{workdir}/git/workspace{repo}.git'
+        commit = _create_git_workspace(path, workspace_crates)
+
+        for idx in range(workspace_crates):
+            packages.append({
+                'name': f'crate_workspace{repo}.git_{idx:04}',
+                'version': '0.1.0',
+                'source': f'git+{GIT_HOST}/workspace{repo}.git?rev={commit[:7]}#{commit}',
+            })
+
+    for idx in range(count):
+        name = f'crate_{idx:05}'
+        version = f'{idx % 3}.{idx % 11}.{idx % 17}'
+        packages.append({
+            'name': name,
+            'version': version,
+            'source': 'registry+https://github.com/rust-lang/crates.io-index',
+            'checksum': _checksum(name, version),
+        })
+
+    path = f'{workdir}/{APP}/rust'
+    os.makedirs(path, exist_ok=True)
+
+    with open(f'{path}/Cargo.lock', 'w') as output:
+        output.write('version = 4\n')
+
+        for package in packages:
+            output.write('\n[[package]]\n')
+
+            for key, value in package.items():
+                output.write(f'{key} = "{value}"\n')
+
+    return f'{path}/Cargo.lock'
+
+
+@contextlib.contextmanager
+def _quiet():
+    # The progress output of the code under test would drown the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        yield
+
+
+def _measure(benchmark: Benchmark, repeat: int) -> Dict[str, float]:
+    timings = []
+
+    for _ in range(max(1, repeat)):
+        if benchmark.setup is not None:
+            benchmark.setup()
+
+        start = time.perf_counter()
+        benchmark.run()
+        timings.append(time.perf_counter() - start)
+
+    # Memory is measured in a separate run, tracing slows down the code under test
+    if benchmark.setup is not None:
+        benchmark.setup()
+
+    tracemalloc.start()
+
+    try:
+        benchmark.run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'time': statistics.median(timings), 'peak': peak / 1024 ** 2}
+
+
+def _format(value: float, baseline: Optional[float], unit: str) -> str:
+    text = f'{value:.3f}{unit}' if unit == 's' else f'{value:.1f}{unit}'
+
+    if baseline is None or baseline == 0:
+        return text
+
+    return f'{text} ({(value / baseline - 1) * 100:+.0f}%)'
+
+
+def print_report(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]]):
+    rows = [['Benchmark', 'Time', 'Peak memory']]
+
+    for name, result in results.items():
+        previous = baseline.get(name, {})
+        rows.append([
+            name,
+            _format(result['time'], previous.get('time'), 's'),
+            _format(result['peak'], previous.get('peak'), ' MiB'),
+        ])
+
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+
+    for row in rows:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+def get_regressions(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]], threshold: float) -> List[str]:
+    regressions = []
+
+    for name, result in results.items():
+        for key in ['time', 'peak']:
+            previous = baseline.get(name, {}).get(key)
+
+            if previous and result[key] > previous * (1 + threshold / 100):
+                regressions.append(f'{name}: {key} {(result[key] / previous - 1) * 100:.0f}% above the baseline')
+
+    return regressions
+
+
+def run_benchmarks(args, workdir: str) -> Dict[str, Dict[str, float]]:
+    foreign_deps_path = f'{os.path.dirname(os.path.abspath(__file__))}/foreign_deps'
+    cache_dir = f'{workdir}/cache'
+
+    print(f'Creating fixtures in {workdir}...')
+    pubspec_paths = create_pubspec_locks(workdir, args.packages, f'{foreign_deps_path}/foreign_deps.json')
+    cargo_lock = create_cargo_lock(workdir, args.crates, args.git_repos, args.workspace_crates)
+
+    # Fully offline, the git dependencies are cloned from local bare repos into a private cache
+    os.environ['XDG_CACHE_HOME'] = cache_dir
+    os.environ['GIT_CONFIG_COUNT'] = '1'
+    os.environ['GIT_CONFIG_KEY_0'] = f'url.file://{workdir}/git/.insteadOf'
+    os.environ['GIT_CONFIG_VALUE_0'] = f'{GIT_HOST}/'
+    os.chdir(workdir)
+
+    def clear_cache():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    with _quiet():
+        pubspec_sources, _ = generate_pubspec_sources(pubspec_paths)
+        cargo_sources, _ = asyncio.run(generate_cargo_sources([cargo_lock], 'config.toml'))
+        _, _, foreign, _ = converter._handle_foreign_dependencies(APP, APP, foreign_deps_path, workdir)
+
+    def emit_manifest():
+        os.makedirs(converter.SOURCES, exist_ok=True)
+        files = {**converter._dump_sources('pubspec.json', pubspec_sources + foreign), **converter._dump_sources('cargo.json', cargo_sources)}
+
+        for path, contents in files.items():
+            with open(path, 'w') as output:
+                output.write(contents)
+
+        manifest = {
+            'app-id': 'com.example.App',
+            'modules': [{
+                'name': APP,
+                'buildsystem': 'simple',
+                'sources': [f'{converter.SOURCES}/cargo.json', f'{converter.SOURCES}/pubspec.json'],
+            }],
+        }
+
+        with open(f'{APP}.yml', 'w') as output:
+            yaml.dump(data=manifest, stream=output, indent=2, sort_keys=False, Dumper=Dumper)
+
+    benchmarks = [
+        Benchmark('pubspec generate_sources', lambda: generate_pubspec_sources(pubspec_paths)),
+        Benchmark('cargo generate_sources (cold)', lambda: asyncio.run(generate_cargo_sources([cargo_lock], 'config.toml')), clear_cache),
+        Benchmark('cargo generate_sources (warm)', lambda: asyncio.run(generate_cargo_sources([cargo_lock], 'config.toml'))),
+        Benchmark('foreign dependencies', lambda: converter._handle_foreign_dependencies(APP, APP, foreign_deps_path, workdir)),
+        Benchmark('manifest emission', emit_manifest),
+    ]
+    results = {}
+
+    print(f'{len(pubspec_sources)} pub sources, {len(cargo_sources)} cargo sources, {len(foreign)} foreign sources\n')
+
+    for benchmark in benchmarks:
+        if args.only and benchmark.name.split(' ')[0] not in args.only:
+            continue
+
+        with _quiet():
+            results[benchmark.name] = _measure(benchmark, args.repeat)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the source generation on synthetic, large scale fixtures')
+    parser.add_argument('--packages', metavar='N', type=int, default=2000, help='Number of packages in the pubspec.lock')
+    parser.add_argument('--crates', metavar='N', type=int, default=3000, help='Number of crates.io crates in the Cargo.lock')
+    parser.add_argument('--git-repos', metavar='N', type=int, default=3, help='Number of local git repos with a Cargo workspace')
+    parser.add_argument('--workspace-crates', metavar='N', type=int, default=200, help='Number of crates per workspace')
+    parser.add_argument('--repeat', metavar='N', type=int, default=3, help='Number of timed runs per benchmark, the median is reported')
+    parser.add_argument('--only', metavar='NAME', nargs='+', choices=['pubspec', 'cargo', 'foreign', 'manifest'], help='Run only the given benchmarks')
+    parser.add_argument('--workdir', metavar='DIR', help='Keep the fixtures in DIR, which must not exist or be empty, instead of a temporary directory')
+    parser.add_argument('--baseline', metavar='FILE', help='Compare with the results stored in FILE')
+    parser.add_argument('--save', metavar='FILE', help='Store the results in FILE, for later comparison')
+    parser.add_argument('--threshold', metavar='PCT', type=float, default=20, help='Percentage above the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    config = {key: getattr(args, key) for key in ['packages', 'crates', 'git_repos', 'workspace_crates']}
+    baseline = {}
+
+    if args.baseline:
+        with open(args.baseline, 'r') as input:
+            stored = json.load(input)
+
+        if stored['config'] != config:
+            print(f'Warning: {args.baseline} was measured with different fixtures: {stored["config"]}', file=sys.stderr)
+
+        baseline = stored['results']
+
+    save = os.path.abspath(args.save) if args.save else None
+    cwd = os.getcwd()
+
+    if args.workdir:
+        workdir = os.path.abspath(args.workdir)
+
+        if os.path.isdir(workdir) and os.listdir(workdir):
+            print(f'Error: {workdir} is not empty', file=sys.stderr)
+            exit(1)
+
+        os.makedirs(workdir, exist_ok=True)
+    else:
+        workdir = tempfile.mkdtemp(prefix='flatpak-flutter-benchmark-')
+
+    try:
+        results = run_benchmarks(args, workdir)
+    finally:
+        os.chdir(cwd)
+
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(results, baseline)
+
+    if save:
+        with open(save, 'w') as output:
+            json.dump({'config': config, 'results': results}, output, indent=4)
+
+    regressions = get_regressions(results, baseline, args.threshold)
+
+    if regressions:
+        print(f'\nRegressions beyond {args.threshold:g}%:')
+
+        for regression in regressions:
+            print(f'  {regression}')
+
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,18 @@
 __license__ = 'MIT'
 import json
 import os
-import contextlib
 import copy
 import subprocess
 import argparse
 import logging
+import shutil
+import sys
 import asyncio
 import tomlkit
 
+from git_archives.git_archives import get_archive_source
 from pathlib import Path
+from profiler import profiler
 from typing import Any, Dict, List, NamedTuple, Optional, Tuple, TypedDict
 from urllib.parse import urlparse, ParseResult, parse_qs
 
@@ -24,16 +27,6 @@ GIT_CACHE = 'flatpak-cargo/git'
 COMMIT_LEN = 7
 
 
-@contextlib.contextmanager
-def _workdir(path: str):
-    oldpath = os.getcwd()
-    os.chdir(path)
-    try:
-        yield
-    finally:
-        os.chdir(oldpath)
-
-
 def _canonical_url(url: str) -> ParseResult:
     'Converts a string to a Cargo Canonical URL, as per https://github.com/rust-lang/cargo/blob/35c55a93200c84a4de4627f1770f76a8ad268a39/src/cargo/util/canonical_url.rs#L19'
     # Hrm. The upstream cargo does not replace those URLs, but if we don't then it doesn't work too well :(
@@ -67,22 +60,41 @@ def _git_repo_name(git_url: str, commit: str) -> str:
     return f'{name}-{commit[:COMMIT_LEN]}'
 
 
-def _fetch_git_repo(git_url: str, commit: str) -> str:
+def _run_git(args: List[str], cwd: Optional[str] = None):
+    # Forward the output via sys.stderr, to keep it together with the other output of the caller
+    result = profiler.run(f'git {args[0]}', ['git'] + args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    sys.stderr.write(result.stdout.decode('utf-8', errors='replace'))
+    result.check_returncode()
+
+
+def _get_clone_dir(git_url: str, commit: str) -> str:
     repo_dir = f'{git_url.replace("://", "_").replace("/", "_")}_{commit[:COMMIT_LEN]}'
     cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
-    clone_dir = os.path.join(cache_dir, 'flatpak-cargo', repo_dir)
-    if not os.path.isdir(clone_dir):
-        subprocess.run(['git', 'clone', '--depth=1', git_url, clone_dir], check=True)
-    rev_parse_proc = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=clone_dir, check=True,
-                                    stdout=subprocess.PIPE)
+
+    return os.path.join(cache_dir, 'flatpak-cargo', repo_dir)
+
+
+def _fetch_git_repo(git_url: str, commit: str) -> str:
+    clone_dir = _get_clone_dir(git_url, commit)
+    with profiler.span('git mirror', 'cache', url=git_url, cache='hit' if os.path.isdir(clone_dir) else 'miss'):
+        if not os.path.isdir(clone_dir):
+            # Clone and rename, concurrent runs can share the cache
+            _run_git(['clone', '--depth=1', git_url, f'{clone_dir}.{os.getpid()}'])
+
+            try:
+                os.rename(f'{clone_dir}.{os.getpid()}', clone_dir)
+            except OSError:
+                shutil.rmtree(f'{clone_dir}.{os.getpid()}')
+    rev_parse_proc = profiler.run('git rev-parse', ['git', 'rev-parse', 'HEAD'], cwd=clone_dir, check=True,
+                                  stdout=subprocess.PIPE)
     head = rev_parse_proc.stdout.decode().strip()
     if head[:COMMIT_LEN] != commit[:COMMIT_LEN]:
-        subprocess.run(['git', 'fetch', 'origin', commit], cwd=clone_dir, check=True)
-        subprocess.run(['git', 'checkout', commit], cwd=clone_dir, check=True)
+        _run_git(['fetch', 'origin', commit], clone_dir)
+        _run_git(['checkout', commit], clone_dir)
 
     # Get the submodules as they might contain dependencies. This is a noop if
     # there are no submodules in the repository
-    subprocess.run(['git', 'submodule', 'update', '--init', '--recursive'], cwd=clone_dir, check=True)
+    _run_git(['submodule', 'update', '--init', '--recursive'], clone_dir)
 
     return clone_dir
 
@@ -149,26 +161,26 @@ async def _get_git_repo_packages(git_url: str, commit: str) -> _GitPackagesType:
     packages: _GitPackagesType = {}
 
     def _get_cargo_toml_packages(root_dir: str, workspace: Optional[_TomlType] = None):
-        assert not os.path.isabs(root_dir) and os.path.isdir(root_dir)
-
-        with _workdir(root_dir):
-            if os.path.exists('Cargo.toml'):
-                cargo_toml = _load_toml('Cargo.toml')
-                workspace = cargo_toml.get('workspace') or workspace
-
-                if 'package' in cargo_toml:
-                    packages[cargo_toml['package']['name']] = _GitPackage(
-                        path=os.path.normpath(root_dir),
-                        package=cargo_toml,
-                        workspace=workspace
-                    )
-        for child in os.scandir(root_dir):
+        # Paths are resolved against the repo dir, changing the working directory isn't thread safe
+        repo_root_dir = os.path.join(git_repo_dir, root_dir)
+        assert not os.path.isabs(root_dir) and os.path.isdir(repo_root_dir)
+
+        if os.path.exists(os.path.join(repo_root_dir, 'Cargo.toml')):
+            cargo_toml = _load_toml(os.path.join(repo_root_dir, 'Cargo.toml'))
+            workspace = cargo_toml.get('workspace') or workspace
+
+            if 'package' in cargo_toml:
+                packages[cargo_toml['package']['name']] = _GitPackage(
+                    path=os.path.normpath(root_dir),
+                    package=cargo_toml,
+                    workspace=workspace
+                )
+        for child in os.scandir(repo_root_dir):
             if child.is_dir():
                 # the workspace can be referenced by any subdirectory
-                _get_cargo_toml_packages(child.path, workspace)
+                _get_cargo_toml_packages(os.path.join(root_dir, child.name), workspace)
 
-    with _workdir(git_repo_dir):
-        _get_cargo_toml_packages('.')
+    _get_cargo_toml_packages('.')
 
     assert packages, f"No packages found in {git_repo_dir}"
     logging.debug(
@@ -188,12 +200,22 @@ _FlatpakSourceType = Dict[str, Any]
 async def _get_git_repo_sources(
     url: str,
     commit: str,
+    archives: bool,
 ) -> List[_FlatpakSourceType]:
+    dest = f'{GIT_CACHE}/{_git_repo_name(url, commit)}'
+
+    # Archives don't include submodules, those repos are still fetched with git
+    if archives and not os.path.isfile(os.path.join(_get_clone_dir(url, commit), '.gitmodules')):
+        archive = await asyncio.to_thread(get_archive_source, url, commit, dest)
+
+        if archive is not None:
+            return [archive]
+
     return [{
         'type': 'git',
         'url': url,
         'commit': commit,
-        'dest': f'{GIT_CACHE}/{_git_repo_name(url, commit)}',
+        'dest': dest,
     }]
 
 
@@ -336,51 +358,119 @@ def _dedupe(current: list, new: list):
     return deduped
 
 
-async def generate_sources(cargo_lock_paths: List[str], config_filename: str) -> Tuple[List[_FlatpakSourceType], int]:
-    sources: List[_FlatpakSourceType] = []
-    cargo_vendored_sources = {
-        VENDORED_SOURCES: {'directory': f'{CARGO_CRATES}'},
-    }
-    deduped = 0
+_PackageKeyType = Tuple[str, str, str]
 
-    for cargo_lock_path in cargo_lock_paths:
-        git_repos: _GitReposType = {}
-        package_sources = []
-        cargo_lock_path = str(Path(cargo_lock_path).expanduser())
-        logging.debug(cargo_lock_path)
-        cargo_lock = _load_toml(cargo_lock_path)
-
-        pkg_coros = [_get_package_sources(p, cargo_lock, git_repos) for p in cargo_lock['package']]
-        for pkg in await asyncio.gather(*pkg_coros):
-            if pkg is None:
-                continue
-
-            pkg_sources, cargo_vendored_entry = pkg
-            package_sources.extend(pkg_sources)
-            cargo_vendored_sources.update(cargo_vendored_entry)
-
-        logging.debug('Adding collected git repos:\n%s', json.dumps(list(git_repos), indent=4))
-        git_repo_coros = []
-        for git_url, git_repo in git_repos.items():
-            for git_commit in git_repo['commits']:
-                git_repo_coros.append(_get_git_repo_sources(git_url, git_commit))
-
-        deduped += _dedupe(sources, sum(await asyncio.gather(*git_repo_coros), []))
-        deduped += _dedupe(sources, package_sources)
 
+async def _get_cargo_lock_sources(
+    cargo_lock_path: str,
+    archives: bool,
+) -> Tuple[List[List[_FlatpakSourceType]], List[Tuple[_PackageKeyType, List[_FlatpakSourceType]]], _VendorEntryType]:
+    git_repos: _GitReposType = {}
+    package_sources = []
+    cargo_vendored_sources = {}
+    cargo_lock_path = str(Path(cargo_lock_path).expanduser())
+    logging.debug(cargo_lock_path)
+    cargo_lock = _load_toml(cargo_lock_path)
+
+    pkg_coros = [_get_package_sources(p, cargo_lock, git_repos) for p in cargo_lock['package']]
+    for package, pkg in zip(cargo_lock['package'], await asyncio.gather(*pkg_coros)):
+        if pkg is None:
+            continue
+
+        pkg_sources, cargo_vendored_entry = pkg
+        key = (package['name'], package['version'], package.get('source', ''))
+        package_sources.append((key, pkg_sources))
+        cargo_vendored_sources.update(cargo_vendored_entry)
+
+    logging.debug('Adding collected git repos:\n%s', json.dumps(list(git_repos), indent=4))
+    git_repo_coros = []
+    for git_url, git_repo in git_repos.items():
+        for git_commit in git_repo['commits']:
+            git_repo_coros.append(_get_git_repo_sources(git_url, git_commit, archives))
+
+    return await asyncio.gather(*git_repo_coros), package_sources, cargo_vendored_sources
+
+
+def _get_config_source(cargo_vendored_sources: _VendorEntryType, config_filename: str) -> _FlatpakSourceType:
     logging.debug('Vendored sources:\n%s', json.dumps(cargo_vendored_sources, indent=4))
-    sources.append({
+
+    return {
         'type': 'inline',
         'contents': tomlkit.dumps({
             'source': cargo_vendored_sources,
         }),
         'dest': CARGO_HOME,
         'dest-filename': config_filename
-    })
+    }
+
+
+async def generate_sources(cargo_lock_paths: List[str], config_filename: str, archives: bool = False) -> Tuple[List[_FlatpakSourceType], int]:
+    sources: List[_FlatpakSourceType] = []
+    cargo_vendored_sources = {
+        VENDORED_SOURCES: {'directory': f'{CARGO_CRATES}'},
+    }
+    deduped = 0
+
+    for cargo_lock_path in cargo_lock_paths:
+        git_repo_sources, package_sources, cargo_vendored_entries = await _get_cargo_lock_sources(cargo_lock_path, archives)
+        cargo_vendored_sources.update(cargo_vendored_entries)
+
+        deduped += _dedupe(sources, sum(git_repo_sources, []))
+        deduped += _dedupe(sources, sum([pkg_sources for _, pkg_sources in package_sources], []))
+
+    sources.append(_get_config_source(cargo_vendored_sources, config_filename))
 
     return sources, deduped
 
 
+async def generate_shards(
+    shards: List[Tuple[str, List[str]]],
+    config_filename: str,
+    archives: bool = False,
+) -> Tuple[List[Tuple[str, List[_FlatpakSourceType]]], _FlatpakSourceType, int]:
+    sharded_sources = []
+    cargo_vendored_sources = {}
+    seen = set()
+    deduped = 0
+
+    for shard, cargo_lock_paths in shards:
+        git_repos = []
+        packages = []
+
+        for cargo_lock_path in cargo_lock_paths:
+            git_repo_sources, package_sources, cargo_vendored_entries = await _get_cargo_lock_sources(cargo_lock_path, archives)
+            cargo_vendored_sources.update(cargo_vendored_entries)
+
+            for sources in git_repo_sources:
+                git_repos.append((json.dumps(sources, sort_keys=True), sources))
+
+            for key, sources in package_sources:
+                packages.append((key, json.dumps(sources, sort_keys=True), sources))
+
+        git_repos.sort(key=lambda git_repo: git_repo[0])
+        packages.sort(key=lambda package: package[:2])
+
+        # Git repos precede the packages copied out of them, a repo or package is emitted
+        # once, in the first shard that needs it
+        shard_sources = []
+
+        for canonical, sources in git_repos + [(canonical, sources) for _, canonical, sources in packages]:
+            if canonical in seen:
+                deduped += 1
+            else:
+                seen.add(canonical)
+                shard_sources += sources
+
+        sharded_sources.append((shard, shard_sources))
+
+    cargo_vendored_sources = {
+        VENDORED_SOURCES: {'directory': f'{CARGO_CRATES}'},
+        **dict(sorted(cargo_vendored_sources.items())),
+    }
+
+    return sharded_sources, _get_config_source(cargo_vendored_sources, config_filename), deduped
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('cargo_lock_paths', help='Comma separated list of paths to Cargo.lock files')
@@ -0,0 +1,561 @@
+__license__ = 'MIT'
+import subprocess
+import shutil
+import os
+import sys
+import yaml
+import json
+import asyncio
+import glob
+import re
+import threading
+
+from pathlib import Path
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+from flutter_sdk_generator.flutter_sdk_generator import DEFAULT_SDK_INSTALL, DEFAULT_SDK_SOURCE, TOOLS_LOCK, generate_sdk, set_sdk_install, set_sdk_source
+from flutter_app_fetcher.flutter_app_fetcher import FetchError, fetch_flutter_app
+from foreign_deps.foreign_deps import load_index
+from pubspec_generator.pubspec_generator import PUB_CACHE
+from cargo_generator.cargo_generator import generate_sources as generate_cargo_sources
+from cargo_generator.cargo_generator import generate_shards as generate_cargo_shards
+from pubspec_generator.pubspec_generator import generate_sources as generate_pubspec_sources
+from pubspec_generator.pubspec_generator import generate_shards as generate_pubspec_shards
+from rustup_generator.rustup_generator import generate_rustup
+from manifest_sources.manifest_sources import ARCHES, compact_sources, filter_arches
+from native_inputs.native_inputs import discover
+from stage_runner.stage_runner import Stage, redirect_output, run_stages
+from profiler import profiler
+from packaging.version import Version
+
+__version__ = '0.15.0'
+
+MODULES = 'generated/modules'
+SOURCES = 'generated/sources'
+PATCHES = 'generated/patches'
+BUILD_PATH = '.flatpak-builder/build'
+
+DEFAULT_RUST_VERSION = '1.94.0'
+RUSTUP_PATH = '/var/lib/rustup'
+
+_DATA_ROOT = os.environ.get('FLATPAK_FLUTTER_ROOT', str(Path(__file__).parent.parent))
+
+
+class ConversionError(Exception):
+    pass
+
+
+class Options(NamedTuple):
+    app_module: Optional[str] = None
+    app_pubspec: Optional[str] = None
+    extra_pubspecs: Tuple[str, ...] = ()
+    cargo_locks: Tuple[str, ...] = ()
+    discovery: bool = True
+    shallow_clone: bool = True
+    sparse_clone: bool = False
+    keep_build_dirs: bool = False
+    reuse_build_dirs: bool = False
+    shard_sources: bool = False
+    compact_sources: bool = False
+    git_archives: bool = False
+    jobs: int = 4
+    seed_state_dir: Optional[str] = None
+    arches: Tuple[str, ...] = tuple(ARCHES)
+    sdk_install: str = DEFAULT_SDK_INSTALL
+    sdk_source: str = DEFAULT_SDK_SOURCE
+    releases_path: str = f'{_DATA_ROOT}/releases'
+    foreign_deps_path: str = f'{_DATA_ROOT}/foreign_deps'
+    # Receives the output lines of the conversion instead of stdout and stderr
+    log: Optional[Callable[[str], None]] = None
+
+
+class Conversion(NamedTuple):
+    app_id: str
+    manifest: Dict[str, Any]
+    # Contents of the generated files, by their path relative to the workspace root
+    files: Dict[str, str]
+
+
+class Cache:
+    # Modules generated from the network, shared by the conversions using this cache
+    def __init__(self):
+        self._modules: Dict[Tuple[Any, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def get_module(self, key: Tuple[Any, ...], generate: Callable[[], Any]) -> Any:
+        with self._lock:
+            if key in self._modules:
+                return self._modules[key]
+
+        module = generate()
+
+        with self._lock:
+            return self._modules.setdefault(key, module)
+
+
+def _create_pub_cache(build_path_app: str, sdk_path: str, pubspec_path: str):
+    full_pubspec_path = f'{build_path_app}/{pubspec_path}'
+
+    if os.path.isfile(f'{full_pubspec_path}/pubspec.lock'):
+        pub_cache = f'{os.path.abspath(build_path_app)}/.{PUB_CACHE}'
+        flutter = f'{sdk_path}/bin/flutter'
+        options = f'PUB_CACHE={pub_cache} {build_path_app}/{flutter} pub get -C {full_pubspec_path}'
+
+        profiler.run('flutter pub get', [options], stdout=subprocess.PIPE, shell=True, check=True)
+    else:
+        raise ConversionError(
+            f'Expected to find pubspec.lock in: {pubspec_path}\n'
+            'Specify path using modules.subdir or use the --app-pubspec command line parameter'
+        )
+
+
+def _handle_foreign_dependencies(app: str, build_path_app: str, foreign_deps_path: str, manifest_root: str):
+    abs_path = os.path.abspath(build_path_app)
+    extra_pubspecs = []
+    cargo_locks = []
+    sources = []
+    patches = {}
+
+    def append_dependency(foreign_dep, pub_dev: str= ""):
+        if 'extra_pubspecs' in foreign_dep:
+            for pubspec in foreign_dep['extra_pubspecs']:
+                extra_pubspecs.append(str(pubspec).replace('$PUB_DEV', pub_dev))
+
+        if 'cargo_locks' in foreign_dep:
+            for cargo_lock in foreign_dep['cargo_locks']:
+                cargo_locks.append(str(cargo_lock).replace('$PUB_DEV', pub_dev))
+
+        if 'manifest' in foreign_dep and 'sources' in foreign_dep['manifest']:
+            for source in foreign_dep['manifest']['sources']:
+                if source['type'] == 'patch':
+                    dst_path = source['path']
+                    src_path = f'{foreign_deps_path}/{dst_path}'
+
+                    if os.path.isfile(src_path):
+                        print(f'Generating patch: {dst_path}...')
+                        dst_path = f'{PATCHES}/{dst_path}'
+                        source['path'] = dst_path
+                        patches[dst_path] = _read(src_path)
+
+                if 'dest' in source:
+                    dest = str(source['dest']).replace('$PUB_DEV', pub_dev)
+                    dest = dest.replace('$APP', app)
+                    source['dest'] = dest
+
+                sources.append(source)
+
+    index = load_index(f'{foreign_deps_path}/foreign_deps.json', f'{manifest_root}/foreign.json')
+
+    for dependency in index.get_local():
+        append_dependency(dependency)
+
+    with open(f'{abs_path}/pubspec.lock') as deps:
+        deps = yaml.full_load(deps)
+
+        for name in index.packages:
+            if name in deps['packages']:
+                dep = deps['packages'][name]
+                dep_version = dep['version']
+                foreign_dep = index.resolve(name, dep_version)
+
+                if dep['source'] == 'hosted':
+                    pub_dev = f".{PUB_CACHE}/hosted/pub.dev/{name}-{dep_version}"
+                    append_dependency(foreign_dep, pub_dev)
+                else:
+                    print(f'Warning: Skipping foreign dependency {name}, not sourced from pub.dev', file=sys.stderr)
+
+    return extra_pubspecs, cargo_locks, sources, patches
+
+
+def _discover_native_inputs(build_path_app: str, app_pubspec: str, known: set, foreign: list, extra_pubspecs: list, cargo_locks: list):
+    discovered = discover(build_path_app, app_pubspec, known)
+    foreign_urls = [source.get('url') for source in foreign]
+
+    for path in discovered.extra_pubspecs:
+        if path not in [os.path.normpath(extra_pubspec) for extra_pubspec in extra_pubspecs]:
+            print(f'Discovered pubspec: {path}')
+            extra_pubspecs.append(path)
+
+    for path in discovered.cargo_locks:
+        if path not in [os.path.normpath(cargo_lock) for cargo_lock in cargo_locks]:
+            print(f'Discovered Cargo.lock: {path}')
+            cargo_locks.append(path)
+
+    for download in discovered.downloads:
+        if download.url not in foreign_urls:
+            site = download.url if download.url else 'an unknown location'
+            print(f'Warning: {download.package} may download from {site} during the build, see {download.path}', file=sys.stderr)
+
+
+def _update_pubspec_build_options(module):
+    app = module['name']
+
+    if 'build-options' in module:
+        build_options = module['build-options']
+
+        if 'env' not in build_options:
+            build_options['env'] = {}
+
+        env = build_options['env']
+        pub_cache_path = f'/run/build/{app}/.pub-cache'
+        if 'PUB_CACHE' not in env or env['PUB_CACHE'] != pub_cache_path:
+            build_options['env']['PUB_CACHE'] = pub_cache_path
+            module['build-options'] = build_options
+
+
+def _get_tools_lock(build_path_app: str, sdk_path: str, tag: str, releases: str) -> str:
+    # The flutter_tools lock is fixed per tag, the catalog copy spares reading the SDK checkout
+    if os.path.isfile(f'{releases}/flutter/{tag}/{TOOLS_LOCK}'):
+        return f'{releases}/flutter/{tag}/{TOOLS_LOCK}'
+
+    return f'{build_path_app}/{sdk_path}/packages/flutter_tools/pubspec.lock'
+
+
+def _generate_pubspec_sources(build_path_app: str, app_pubspec:str, extra_pubspecs: list, foreign: list, tools_lock: str, compact: bool) -> Dict[str, str]:
+    pubspec_json = 'pubspec.json'
+    pubspec_paths = [
+        f'{build_path_app}/{app_pubspec}/pubspec.lock',
+        tools_lock,
+    ]
+
+    if extra_pubspecs:
+        for path in extra_pubspecs:
+            pubspec_paths.append(f'{build_path_app}/{path}/pubspec.lock')
+
+    print(f'Generating source: {pubspec_json}...', end='')
+
+    pubspec_sources, deduped = generate_pubspec_sources(pubspec_paths)
+
+    if compact:
+        pubspec_sources = compact_sources(pubspec_sources)
+
+    pubspec_sources += foreign
+
+    if deduped:
+        print(f' (deduped {deduped} entries)')
+    else:
+        print()
+
+    return _dump_sources(pubspec_json, pubspec_sources)
+
+
+def _get_pubspec_shards(build_path_app: str, app_pubspec: str, extra_pubspecs: list, tools_lock: str) -> list:
+    # The SDK tooling shard comes first, it only changes with the SDK tag
+    shards = [
+        ('pubspec-sdk.json', [tools_lock]),
+        ('pubspec-app.json', [f'{build_path_app}/{app_pubspec}/pubspec.lock']),
+    ]
+
+    if extra_pubspecs:
+        shards.append(('pubspec-extra.json', [f'{build_path_app}/{path}/pubspec.lock' for path in extra_pubspecs]))
+
+    return shards
+
+
+def _generate_pubspec_shards(shards: list, foreign: list, compact: bool) -> Dict[str, str]:
+    print(f'Generating sources: {", ".join(shard for shard, _ in shards)}...', end='')
+
+    pubspec_shards, deduped = generate_pubspec_shards(shards)
+    outputs = {}
+
+    for shard, sources in pubspec_shards:
+        outputs.update(_dump_sources(shard, compact_sources(sources) if compact else sources))
+
+    if deduped:
+        print(f' (deduped {deduped} entries)')
+    else:
+        print()
+
+    if foreign:
+        print('Generating source: pubspec-foreign.json...')
+        outputs.update(_dump_sources('pubspec-foreign.json', foreign))
+
+    return outputs
+
+
+def _dump_sources(filename: str, sources: list) -> Dict[str, str]:
+    return {f'{SOURCES}/{filename}': json.dumps(sources, indent=4, sort_keys=False) + '\n'}
+
+
+def _update_rustup_module(module) -> str:
+    app = module['name']
+    rust_version = None
+
+    if 'modules' in module:
+        for child_module in module['modules']:
+            if isinstance(child_module, str) and 'rustup-' in child_module:
+                rust_version = child_module.split('/')[-1].split('rustup-')[1].split('.json')[0]
+                break
+
+    if rust_version is None:
+        rust_version = DEFAULT_RUST_VERSION
+        _add_child_module(module, f'{MODULES}/rustup-{rust_version}.json')
+
+    if 'build-options' in module:
+        build_options = module['build-options']
+
+        append_path = build_options['append-path'] if 'append-path' in build_options else ''
+        if f'{RUSTUP_PATH}/bin' not in append_path:
+            build_options['append-path'] += f':{RUSTUP_PATH}/bin'
+
+        env = build_options['env'] if 'env' in build_options else {}
+        cargo_path = f'/run/build/{app}/cargo'
+        if 'CARGO_HOME' not in env or env['CARGO_HOME'] != cargo_path:
+            build_options['env']['CARGO_HOME'] = cargo_path
+        if 'RUSTUP_HOME' not in env or env['RUSTUP_HOME'] != RUSTUP_PATH:
+            build_options['env']['RUSTUP_HOME'] = RUSTUP_PATH
+
+        module['build-options'] = build_options
+
+    return rust_version
+
+
+def _generate_rustup_module(rust_version: str, state_dir: Optional[str], arches: Tuple[str, ...], cache: Cache) -> Dict[str, str]:
+    rustup_json = f'rustup-{rust_version}.json'
+    rustup = cache.get_module(
+        ('rustup', rust_version, state_dir, arches),
+        lambda: generate_rustup(rust_version, RUSTUP_PATH, state_dir, list(arches)),
+    )
+
+    print(f'Generating module: {rustup_json}...')
+
+    return {f'{MODULES}/{rustup_json}': json.dumps(rustup, indent=4, sort_keys=False)}
+
+
+def _generate_cargo_sources(build_path_app: str, cargo_locks: list, rust_version: str, compact: bool, archives: bool) -> Dict[str, str]:
+    cargo_paths = []
+
+    for path in cargo_locks:
+        cargo_paths.append(f'{build_path_app}/{path}/Cargo.lock')
+
+    cargo_json = 'cargo.json'
+    config_filename = 'config' if Version(rust_version) < Version('1.38.0') else 'config.toml'
+
+    print(f'Generating source: {cargo_json}...', end='')
+
+    cargo_sources, deduped = asyncio.run(generate_cargo_sources(cargo_paths, config_filename, archives))
+
+    if compact:
+        cargo_sources = compact_sources(cargo_sources)
+
+    if deduped:
+        print(f' (deduped {deduped} entries)')
+    else:
+        print()
+
+    return _dump_sources(cargo_json, cargo_sources)
+
+
+def _get_cargo_shards(build_path_app: str, cargo_locks: list) -> list:
+    shards = []
+
+    for path in cargo_locks:
+        # Name the shards after the package or directory holding the Cargo.lock
+        name = re.sub('[^A-Za-z0-9]+', '-', str(path).split('/hosted/pub.dev/')[-1]).strip('-') or 'app'
+        shard = f'cargo-{name}.json'
+        count = 1
+
+        while shard in [existing for existing, _ in shards]:
+            count += 1
+            shard = f'cargo-{name}-{count}.json'
+
+        shards.append((shard, [f'{build_path_app}/{path}/Cargo.lock']))
+
+    return shards
+
+
+def _generate_cargo_shards(shards: list, rust_version: str, compact: bool, archives: bool) -> Dict[str, str]:
+    config_filename = 'config' if Version(rust_version) < Version('1.38.0') else 'config.toml'
+
+    print(f'Generating sources: {", ".join(shard for shard, _ in shards)}, cargo-config.json...', end='')
+
+    cargo_shards, config, deduped = asyncio.run(generate_cargo_shards(shards, config_filename, archives))
+    outputs = {}
+
+    for shard, sources in cargo_shards:
+        outputs.update(_dump_sources(shard, compact_sources(sources) if compact else sources))
+
+    outputs.update(_dump_sources('cargo-config.json', [config]))
+
+    if deduped:
+        print(f' (deduped {deduped} entries)')
+    else:
+        print()
+
+    return outputs
+
+
+def _get_sdk_module(
+    build_path_app: str,
+    sdk_path: str,
+    tag: str,
+    releases: str,
+    state_dir: Optional[str],
+    arches: Tuple[str, ...],
+    install: str,
+    source: str,
+    cache: Cache,
+) -> Dict[str, str]:
+    flutter_patch = 'flutter/shared.sh.patch'
+    print(f'Generating patch: {flutter_patch}...')
+
+    if Version(tag.split('-')[0]) < Version('3.35.0'):
+        outputs = {f'{PATCHES}/{flutter_patch}': _read(f'{releases}/flutter/flutter-pre-3_35-shared.sh.patch')}
+    else:
+        outputs = {f'{PATCHES}/{flutter_patch}': _read(f'{releases}/flutter/flutter-shared.sh.patch')}
+
+    flutter_sdk_json = f'flutter-sdk-{tag}.json'
+    print(f'Generating module: {flutter_sdk_json}...')
+
+    if (os.path.isfile(f'{releases}/flutter/{tag}/flutter-sdk.json') and set(arches) == set(ARCHES) and
+            install == DEFAULT_SDK_INSTALL and source == DEFAULT_SDK_SOURCE):
+        outputs[f'{MODULES}/{flutter_sdk_json}'] = _read(f'{releases}/flutter/{tag}/flutter-sdk.json')
+    elif os.path.isfile(f'{releases}/flutter/{tag}/flutter-sdk.json'):
+        def get_catalog_sdk():
+            with open(f'{releases}/flutter/{tag}/flutter-sdk.json', 'r') as input:
+                catalog_sdk = json.load(input)
+
+            catalog_sdk['sources'] = filter_arches(catalog_sdk['sources'], list(arches))
+            set_sdk_install(catalog_sdk, install)
+            set_sdk_source(catalog_sdk, source, state_dir)
+
+            return catalog_sdk
+
+        catalog_sdk = cache.get_module(('catalog-sdk', tag, state_dir, arches, install, source), get_catalog_sdk)
+        outputs[f'{MODULES}/{flutter_sdk_json}'] = json.dumps(catalog_sdk, indent=4, sort_keys=False)
+    else:
+        generated_sdk = cache.get_module(
+            ('sdk', tag, state_dir, arches, install, source),
+            lambda: generate_sdk(f'{build_path_app}/{sdk_path}', tag, '../patches/flutter', state_dir, list(arches), install, source),
+        )
+        outputs[f'{MODULES}/{flutter_sdk_json}'] = json.dumps(generated_sdk, indent=4, sort_keys=False)
+
+    return outputs
+
+
+def _read(path: str) -> str:
+    with open(path, 'r') as input:
+        return input.read()
+
+
+def _add_child_module(module, child_module):
+    if 'modules' in module:
+        if child_module not in module['modules']:
+            module['modules'] += [child_module]
+    else:
+        module['modules'] = [child_module]
+
+
+def convert(
+    manifest: Dict[str, Any],
+    root: str = '.',
+    options: Options = Options(),
+    cache: Optional[Cache] = None,
+    manifest_root: Optional[str] = None,
+) -> Conversion:
+    # Converts the manifest in place, the build dirs are kept below root and the generated files are returned
+    if options.log is not None:
+        with redirect_output(options.log):
+            return _convert(manifest, root, options, cache, manifest_root)
+
+    return _convert(manifest, root, options, cache, manifest_root)
+
+
+def _convert(
+    manifest: Dict[str, Any],
+    root: str,
+    options: Options,
+    cache: Optional[Cache],
+    manifest_root: Optional[str],
+) -> Conversion:
+    cache = cache if cache is not None else Cache()
+    manifest_root = manifest_root if manifest_root is not None else root
+    build_path = f'{root}/{BUILD_PATH}'
+
+    try:
+        with profiler.span('fetch', 'stage'):
+            app_id, app_module, app_pubspec, tag, sdk_path, build_id = fetch_flutter_app(
+                manifest,
+                options.app_module,
+                build_path,
+                options.releases_path,
+                options.app_pubspec,
+                not options.shallow_clone,
+                options.reuse_build_dirs,
+                root,
+                options.sparse_clone,
+            )
+    except FetchError as error:
+        raise ConversionError(error) from error
+
+    if not tag or not sdk_path:
+        raise ConversionError(f'No Flutter SDK found in module {app_module}')
+
+    build_path_app = f'{build_path}/{app_module}'
+    _create_pub_cache(build_path_app, sdk_path, app_pubspec)
+
+    print(f'SDK path: {sdk_path}, tag: {tag}')
+
+    with profiler.span('foreign', 'stage'):
+        extra_pubspecs, cargo_locks, foreign, files = _handle_foreign_dependencies(
+            app_pubspec,
+            f'{build_path_app}/{app_pubspec}',
+            options.foreign_deps_path,
+            manifest_root,
+        )
+
+    foreign = filter_arches(foreign, list(options.arches))
+    extra_pubspecs += options.extra_pubspecs
+    cargo_locks += options.cargo_locks
+
+    if options.discovery:
+        # Packages handled by the app's own foreign.json are known as well
+        index = load_index(f'{options.foreign_deps_path}/foreign_deps.json', f'{manifest_root}/foreign.json')
+
+        with profiler.span('discover', 'stage'):
+            _discover_native_inputs(build_path_app, app_pubspec, set(index.packages) | set(index.local), foreign, extra_pubspecs, cargo_locks)
+
+    # The release patches referenced by the manifest, written next to it by the caller
+    for patch in glob.glob(f'{options.releases_path}/flutter/{tag}/*.flutter.patch'):
+        files[Path(patch).name] = _read(patch)
+
+    tools_lock = _get_tools_lock(build_path_app, sdk_path, tag, options.releases_path)
+
+    for module in manifest['modules']:
+        if 'name' in module and module['name'] == app_module:
+            # Manifest updates are applied up front, the stages only generate files
+            _update_pubspec_build_options(module)
+
+            if options.shard_sources:
+                pubspec_shards = _get_pubspec_shards(build_path_app, app_pubspec, extra_pubspecs, tools_lock)
+                pubspec_files = [shard for shard, _ in pubspec_shards] + (['pubspec-foreign.json'] if foreign else [])
+                stages = [Stage('pubspec', lambda _: _generate_pubspec_shards(pubspec_shards, foreign, options.compact_sources))]
+            else:
+                pubspec_files = ['pubspec.json']
+                stages = [Stage('pubspec', lambda _: _generate_pubspec_sources(build_path_app, app_pubspec, extra_pubspecs, foreign, tools_lock, options.compact_sources))]
+
+            stages += [Stage('sdk', lambda _: _get_sdk_module(build_path_app, sdk_path, tag, options.releases_path, options.seed_state_dir, options.arches, options.sdk_install, options.sdk_source, cache))]
+
+            if len(cargo_locks):
+                rust_version = _update_rustup_module(module)
+                stages += [Stage('rustup', lambda _: _generate_rustup_module(rust_version, options.seed_state_dir, options.arches, cache))]
+
+                if options.shard_sources:
+                    cargo_shards = _get_cargo_shards(build_path_app, cargo_locks)
+                    module['sources'] += [f'{SOURCES}/{shard}' for shard, _ in cargo_shards] + [f'{SOURCES}/cargo-config.json']
+                    stages += [Stage('cargo', lambda _: _generate_cargo_shards(cargo_shards, rust_version, options.compact_sources, options.git_archives))]
+                else:
+                    module['sources'] += [f'{SOURCES}/cargo.json']
+                    stages += [Stage('cargo', lambda _: _generate_cargo_sources(build_path_app, cargo_locks, rust_version, options.compact_sources, options.git_archives))]
+
+            for outputs in run_stages(stages, options.jobs).values():
+                files.update(outputs)
+
+            module['sources'] += [f'{SOURCES}/{pubspec_file}' for pubspec_file in pubspec_files]
+            _add_child_module(module, f'{MODULES}/flutter-sdk-{tag}.json')
+            break
+
+    if not options.keep_build_dirs and not options.reuse_build_dirs:
+        shutil.rmtree(f'{build_path}/{app_module}-{build_id}')
+        os.remove(f'{build_path}/{app_module}')
+
+    return Conversion(app_id, manifest, files)
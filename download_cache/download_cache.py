@@ -0,0 +1,116 @@
+__license__ = 'MIT'
+import contextvars
+import hashlib
+import os
+import sys
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from http_client import http_client
+from typing import List, NamedTuple, Tuple
+from urllib.parse import urlsplit
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class PrefetchResult(NamedTuple):
+    cached: int
+    downloaded: int
+    bytes: int
+    failures: List[Tuple[str, str]]
+
+
+def get_download_path(state_dir: str, url: str, sha256: str) -> str:
+    # The layout flatpak-builder uses for the downloads in its state dir
+    return os.path.join(state_dir, 'downloads', sha256, os.path.basename(urlsplit(url).path))
+
+
+def is_cached(state_dir: str, url: str, sha256: str) -> bool:
+    return os.path.isfile(get_download_path(state_dir, url, sha256))
+
+
+def _download(state_dir: str, url: str, sha256: str) -> int:
+    path = get_download_path(state_dir, url, sha256)
+    partial = f'{path}.{os.getpid()}.part'
+    hash = hashlib.sha256()
+    size = 0
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    try:
+        with http_client.open_url(url) as response, open(partial, 'wb') as output:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                hash.update(chunk)
+                output.write(chunk)
+                size += len(chunk)
+
+        if hash.hexdigest() != sha256:
+            raise ValueError(f'sha256 mismatch, got {hash.hexdigest()}')
+
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+    return size
+
+
+def store(state_dir: str, url: str, sha256: str, data: bytes):
+    path = get_download_path(state_dir, url, sha256)
+
+    if os.path.isfile(path):
+        return
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(f'{path}.{os.getpid()}.part', 'wb') as output:
+        output.write(data)
+
+    os.replace(f'{path}.{os.getpid()}.part', path)
+
+
+def download(state_dir: str, url: str) -> str:
+    # The sha256 is only known afterwards, download next to the cache entries and move into place
+    partial = os.path.join(state_dir, 'downloads', f'.{os.path.basename(urlsplit(url).path)}.{os.getpid()}.{threading.get_ident()}.part')
+    hash = hashlib.sha256()
+    os.makedirs(os.path.dirname(partial), exist_ok=True)
+
+    try:
+        with http_client.open_url(url) as response, open(partial, 'wb') as output:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                hash.update(chunk)
+                output.write(chunk)
+
+        path = get_download_path(state_dir, url, hash.hexdigest())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+    return hash.hexdigest()
+
+
+def prefetch(sources: List[Tuple[str, str]], state_dir: str, jobs: int) -> PrefetchResult:
+    missing = sorted(set(source for source in sources if not is_cached(state_dir, *source)))
+    cached = len(set(sources)) - len(missing)
+    failures = []
+    size = 0
+
+    def download(source: Tuple[str, str]):
+        try:
+            return _download(state_dir, *source), None
+        except Exception as error:
+            return 0, f'{error}'
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        # Run in a copy of the context, to keep the active HTTP client
+        futures = [executor.submit(contextvars.copy_context().run, download, source) for source in missing]
+
+        for (url, _), (downloaded, error) in zip(missing, (future.result() for future in futures)):
+            if error is not None:
+                print(f'Warning: Unable to prefetch {url}: {error}', file=sys.stderr)
+                failures.append((url, error))
+            else:
+                size += downloaded
+
+    return PrefetchResult(cached, len(missing) - len(failures), size, failures)
@@ -0,0 +1,114 @@
+__license__ = 'MIT'
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+POLL_INTERVAL = 1.0
+# Editors save in several steps, wait for them to settle
+SETTLE_TIME = 0.2
+SKIPPED_DIRS = {'.git', '.dart_tool', '.flatpak-builder', 'build'}
+
+_SnapshotType = Dict[str, Tuple[int, int]]
+
+
+def _walk(path: str) -> List[str]:
+    if not os.path.isdir(path):
+        return [path]
+
+    paths = []
+
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(dir for dir in dirs if dir not in SKIPPED_DIRS)
+        paths += [os.path.join(root, file) for file in sorted(files)]
+
+    return paths
+
+
+def _snapshot(paths: List[str]) -> _SnapshotType:
+    snapshot = {}
+
+    for path in paths:
+        for file in _walk(path):
+            try:
+                stat = os.stat(file)
+                snapshot[file] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                pass
+
+    return snapshot
+
+
+def _init_inotify() -> Optional[Tuple[ctypes.CDLL, int]]:
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+
+    return (libc, fd) if fd >= 0 else None
+
+
+class FileWatcher:
+    def __init__(self, paths: List[str]):
+        self._paths = paths
+        self._snapshot = _snapshot(paths)
+        self._inotify = _init_inotify()
+
+        if self._inotify is not None:
+            libc, fd = self._inotify
+            dirs = set()
+
+            # Watch the directories, files replaced by a rename are noticed as well
+            for path in paths:
+                dirs.add(os.path.dirname(os.path.abspath(path)))
+
+                if os.path.isdir(path):
+                    dirs.update(os.path.dirname(os.path.abspath(file)) for file in _walk(path))
+
+            for dir in sorted(dirs):
+                if os.path.isdir(dir):
+                    libc.inotify_add_watch(fd, os.fsencode(dir), IN_EVENTS)
+
+    def close(self):
+        if self._inotify is not None:
+            os.close(self._inotify[1])
+            self._inotify = None
+
+    def _wait_for_event(self):
+        if self._inotify is None:
+            time.sleep(POLL_INTERVAL)
+            return
+
+        fd = self._inotify[1]
+        select.select([fd], [], [])
+        time.sleep(SETTLE_TIME)
+
+        try:
+            while os.read(fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def wait(self) -> List[str]:
+        # Blocks until a watched file is created, changed or removed, returns those files
+        while True:
+            self._wait_for_event()
+            snapshot = _snapshot(self._paths)
+            changed = sorted(file for file in set(snapshot) | set(self._snapshot) if snapshot.get(file) != self._snapshot.get(file))
+            self._snapshot = snapshot
+
+            if changed:
+                return changed
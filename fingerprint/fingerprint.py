@@ -0,0 +1,58 @@
+__license__ = 'MIT'
+import glob
+import hashlib
+import json
+import os
+
+from typing import Any, Dict, List, Optional
+
+
+def _hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+
+    with open(path, 'rb') as input:
+        for chunk in iter(lambda: input.read(1024 * 1024), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def hash_files(paths: List[str]) -> Dict[str, Optional[str]]:
+    hashes = {}
+
+    for path in paths:
+        if os.path.isdir(path):
+            for file in sorted(glob.glob(f'{path}/**', recursive=True)):
+                if os.path.isfile(file):
+                    hashes[file] = _hash_file(file)
+        else:
+            hashes[path] = _hash_file(path) if os.path.isfile(path) else None
+
+    return hashes
+
+
+def get_fingerprint(inputs: Dict[str, Any]) -> str:
+    data = json.dumps(inputs, sort_keys=True, separators=(',', ':'))
+
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def is_unchanged(cache_path: str, fingerprint: str) -> bool:
+    if not os.path.isfile(cache_path):
+        return False
+
+    with open(cache_path, 'r') as input:
+        cache = json.load(input)
+
+    if cache.get('fingerprint') != fingerprint:
+        return False
+
+    # The outputs of the previous run have to be untouched to be reused
+    return all(hash_files([path])[path] == sha256 for path, sha256 in cache['outputs'].items())
+
+
+def store(cache_path: str, fingerprint: str, outputs: List[str]):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    with open(cache_path, 'w') as output:
+        json.dump({'fingerprint': fingerprint, 'outputs': hash_files(outputs)}, output, indent=4)
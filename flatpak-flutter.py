@@ -1,36 +1,36 @@
 #!/usr/bin/env python3
 
 __license__ = 'MIT'
-import subprocess
 import shutil
 import argparse
 import os
 import sys
 import yaml
 import json
-import asyncio
+import glob
 
 from pathlib import Path
-from flutter_sdk_generator.flutter_sdk_generator import generate_sdk
-from flutter_app_fetcher.flutter_app_fetcher import fetch_flutter_app
-from git_actions.git_actions import fetch_repos
-from pubspec_generator.pubspec_generator import PUB_CACHE
-from cargo_generator.cargo_generator import generate_sources as generate_cargo_sources
-from pubspec_generator.pubspec_generator import generate_sources as generate_pubspec_sources
-from rustup_generator.rustup_generator import generate_rustup
-from packaging.version import Version
+from typing import Optional
+from converter.converter import BUILD_PATH, Cache, ConversionError, Options, __version__, convert
+from flutter_app_fetcher.flutter_app_fetcher import FLUTTER_URL
+from flutter_sdk_generator.flutter_sdk_generator import DEFAULT_SDK_INSTALL, DEFAULT_SDK_SOURCE, SDK_INSTALLS, SDK_SOURCES
+from git_actions.git_actions import fetch_repos, resolve_ref
+from http_client import http_client
+from file_watcher.file_watcher import FileWatcher
+from fingerprint.fingerprint import get_fingerprint, hash_files, is_unchanged, store
+from manifest_sources.manifest_sources import ARCHES, get_remote_sources
+from source_verifier.source_verifier import verify
+from profiler import profiler
+from profiler.profiler import start_profiling, write_summary, write_trace
 from urllib.parse import urlsplit
 
-MODULES = 'generated/modules'
-SOURCES = 'generated/sources'
-PATCHES = 'generated/patches'
-
 TEMPLATE_FLUTTER_VERSION = '3.44.1'
-DEFAULT_RUST_VERSION = '1.94.0'
-RUSTUP_PATH = '/var/lib/rustup'
+BUNDLE_ARCHES = {'x86_64': 'x64', 'aarch64': 'arm64'}
+
+fingerprint_path = '.flatpak-builder/flatpak-flutter'
 
-__version__ = '0.15.0'
-build_path = '.flatpak-builder/build'
+# Options that don't affect the generated output
+UNFINGERPRINTED_ARGS = ['jobs', 'keep_build_dirs', 'reuse_build_dirs', 'no_cache', 'profile', 'trace', 'record_http', 'verify', 'watch']
 
 
 class Dumper(yaml.Dumper):
@@ -43,7 +43,7 @@ def _get_manifest_from_git(manifest: str, from_git: str, from_git_branch: str):
         return ['.git'] if '.git' in subdirs else []
 
     manifest_name = Path(manifest).stem
-    path = f'{build_path}/{manifest_name}'
+    path = f'{BUILD_PATH}/{manifest_name}'
 
     fetch_repos([(from_git, from_git_branch, path, True, True)])
 
@@ -75,7 +75,7 @@ def _get_app_id(url: str):
     return f'{id}.{path}.{module}'
 
 
-def _generate_template_for_url(url: str, id: str, command: str):
+def _generate_template_for_url(url: str, id: str, command: str, arches: list):
     url = url.removesuffix('.git')
 
     if not id:
@@ -107,16 +107,12 @@ def _generate_template_for_url(url: str, id: str, command: str):
                 'buildsystem': 'simple',
                 'build-options': {
                     'arch': {
-                        'x86_64': {
-                            'env': {
-                                'BUNDLE_PATH': 'build/linux/x64/release/bundle',
-                            }
-                        },
-                        'aarch64': {
+                        arch: {
                             'env': {
-                                'BUNDLE_PATH': 'build/linux/arm64/release/bundle',
+                                'BUNDLE_PATH': f'build/linux/{BUNDLE_ARCHES[arch]}/release/bundle',
                             }
                         }
+                        for arch in ARCHES if arch in arches
                     },
                     'append-path': f'/usr/lib/sdk/llvm20/bin:/run/build/{module}/flutter/bin',
                     'prepend-ld-library-path': '/usr/lib/sdk/llvm20/lib',
@@ -159,7 +155,7 @@ def _get_manifest(args):
             else:
                 manifest = json.load(input_stream)
     elif args.template:
-        manifest = _generate_template_for_url(args.template, args.id, args.command)
+        manifest = _generate_template_for_url(args.template, args.id, args.command, args.arches)
         with open(manifest_path, 'w') as output_stream:
             if suffix == '.yml' or  suffix == '.yaml':
                 yaml.dump(data=manifest, stream=output_stream, indent=2, sort_keys=False, Dumper=Dumper)
@@ -172,221 +168,95 @@ def _get_manifest(args):
     return manifest, manifest_root, suffix
 
 
-def _create_pub_cache(build_path_app: str, sdk_path: str, pubspec_path: str):
-    full_pubspec_path = f'{build_path_app}/{pubspec_path}'
-
-    if os.path.isfile(f'{full_pubspec_path}/pubspec.lock'):
-        pub_cache = f'{os.getcwd()}/{build_path_app}/.{PUB_CACHE}'
-        flutter = f'{sdk_path}/bin/flutter'
-        options = f'PUB_CACHE={pub_cache} {build_path_app}/{flutter} pub get -C {full_pubspec_path}'
-
-        subprocess.run([options], stdout=subprocess.PIPE, shell=True, check=True)
-    else:
-        print(f'Error: Expected to find pubspec.lock in: {pubspec_path}', file=sys.stderr)
-        print('Error: Specify path using modules.subdir or use the --app-pubspec command line parameter', file=sys.stderr)
-        exit(1)
-
-
-def _handle_foreign_dependencies(app: str, build_path_app: str, foreign_deps_path: str, manifest_root: str):
-    abs_path = f'{os.getcwd()}/{build_path_app}'
-    extra_pubspecs = []
-    cargo_locks = []
+def _get_app_sources(args, manifest) -> list:
+    app_id = manifest['app-id'] if 'app-id' in manifest else manifest.get('id', '')
+    app = args.app_module if args.app_module is not None else str(app_id).split('.')[-1]
     sources = []
-    local_deps = []
-
-    def append_dependency(foreign_dep, pub_dev: str= ""):
-        if 'extra_pubspecs' in foreign_dep:
-            for pubspec in foreign_dep['extra_pubspecs']:
-                extra_pubspecs.append(str(pubspec).replace('$PUB_DEV', pub_dev))
-
-        if 'cargo_locks' in foreign_dep:
-            for cargo_lock in foreign_dep['cargo_locks']:
-                cargo_locks.append(str(cargo_lock).replace('$PUB_DEV', pub_dev))
-
-        if 'manifest' in foreign_dep and 'sources' in foreign_dep['manifest']:
-            for source in foreign_dep['manifest']['sources']:
-                if source['type'] == 'patch':
-                    dst_path = source['path']
-                    src_path = f'{foreign_deps_path}/{dst_path}'
-
-                    if os.path.isfile(src_path):
-                        print(f'Generating patch: {dst_path}...')
-                        dst_path = f'{PATCHES}/{dst_path}'
-                        source['path'] = dst_path
-                        os.makedirs(Path(dst_path).parent, exist_ok=True)
-                        shutil.copyfile(src_path, dst_path)
-
-                if 'dest' in source:
-                    dest = str(source['dest']).replace('$PUB_DEV', pub_dev)
-                    dest = dest.replace('$APP', app)
-                    source['dest'] = dest
-
-                sources.append(source)
-
-    if os.path.isfile(f'{manifest_root}/foreign.json'):
-        with open(f'{manifest_root}/foreign.json') as foreign:
-            foreign = json.load(foreign)
-            local_deps = foreign.keys()
-
-            for dependency in foreign.values():
-                append_dependency(dependency)
-
-    with open(f'{foreign_deps_path}/foreign_deps.json', 'r') as foreign_deps, open(f'{abs_path}/pubspec.lock') as deps:
-        foreign_deps = json.load(foreign_deps)
-        deps = yaml.full_load(deps)
-
-        for name in foreign_deps.keys():
-            if name not in local_deps and name in deps['packages']:
-                foreign_dep = foreign_deps[name]
-                foreign_dep_versions = list(foreign_dep.keys())
-                dep = deps['packages'][name]
-                dep_version = dep['version']
-
-                for foreign_dep_version in reversed(foreign_dep_versions):
-                    if Version(foreign_dep_version) <= Version(dep_version):
-                        foreign_dep = foreign_dep[foreign_dep_version]
-                        break
-                else:
-                    foreign_dep = foreign_dep[foreign_dep_versions[0]]
-
-                if dep['source'] == 'hosted':
-                    pub_dev = f".{PUB_CACHE}/hosted/pub.dev/{name}-{dep_version}"
-                    append_dependency(foreign_dep, pub_dev)
-                else:
-                    print(f'Warning: Skipping foreign dependency {name}, not sourced from pub.dev', file=sys.stderr)
-
-    return extra_pubspecs, cargo_locks, sources
-
-
-def _generate_pubspec_sources(module, app_pubspec:str, extra_pubspecs: list, foreign: list, sdk_path: str):
-    app = module['name']
-    flutter_tools = f'{sdk_path}/packages/flutter_tools'
-    pubspec_json = 'pubspec.json'
-    pubspec_paths = [
-        f'{build_path}/{app}/{app_pubspec}/pubspec.lock',
-        f'{build_path}/{app}/{flutter_tools}/pubspec.lock',
-    ]
-
-    if extra_pubspecs:
-        for path in extra_pubspecs:
-            pubspec_paths.append(f'{build_path}/{app}/{path}/pubspec.lock')
-
-    if 'build-options' in module:
-        build_options = module['build-options']
-
-        if 'env' not in build_options:
-            build_options['env'] = {}
-
-        env = build_options['env']
-        pub_cache_path = f'/run/build/{app}/.pub-cache'
-        if 'PUB_CACHE' not in env or env['PUB_CACHE'] != pub_cache_path:
-            build_options['env']['PUB_CACHE'] = pub_cache_path
-            module['build-options'] = build_options
-
-    print(f'Generating source: {pubspec_json}...', end='')
-
-    pubspec_sources, deduped = generate_pubspec_sources(pubspec_paths)
-    pubspec_sources += foreign
-
-    with open(f'{SOURCES}/{pubspec_json}', 'w') as out:
-        json.dump(pubspec_sources, out, indent=4, sort_keys=False)
-        out.write('\n')
-        if deduped:
-            print(f' (deduped {deduped} entries)')
-        else:
-            print()
 
+    for module in manifest.get('modules', []):
+        if isinstance(module, dict) and str(module.get('name', '')).lower() == app.lower():
+            sources += [source for source in module.get('sources', []) if isinstance(source, dict)]
 
-def _generate_rustup_module(module) -> str:
-    app = module['name']
-    rust_version = None
+    return sources
 
-    if 'modules' in module:
-        for child_module in module['modules']:
-            if isinstance(child_module, str) and 'rustup-' in child_module:
-                rust_version = child_module.split('/')[-1].split('rustup-')[1].split('.json')[0]
-                break
 
-    if rust_version is None:
-        rust_version = DEFAULT_RUST_VERSION
-        _add_child_module(module, f'{MODULES}/rustup-{rust_version}.json')
+def _get_foreign_deps_files(foreign_deps: str, foreign_json: str) -> list:
+    # Only the data is an input, not the code living next to it
+    with open(f'{foreign_deps}/foreign_deps.json', 'r') as input:
+        entries = [entry for versions in json.load(input).values() for entry in versions.values()]
 
-    if 'build-options' in module:
-        build_options = module['build-options']
+    if os.path.isfile(foreign_json):
+        with open(foreign_json, 'r') as input:
+            entries += list(json.load(input).values())
 
-        append_path = build_options['append-path'] if 'append-path' in build_options else ''
-        if f'{RUSTUP_PATH}/bin' not in append_path:
-            build_options['append-path'] += f':{RUSTUP_PATH}/bin'
+    patches = set()
 
-        env = build_options['env'] if 'env' in build_options else {}
-        cargo_path = f'/run/build/{app}/cargo'
-        if 'CARGO_HOME' not in env or env['CARGO_HOME'] != cargo_path:
-            build_options['env']['CARGO_HOME'] = cargo_path
-        if 'RUSTUP_HOME' not in env or env['RUSTUP_HOME'] != RUSTUP_PATH:
-            build_options['env']['RUSTUP_HOME'] = RUSTUP_PATH
+    for entry in entries:
+        for source in entry.get('manifest', {}).get('sources', []):
+            if source.get('type') == 'patch' and 'path' in source:
+                patches.add(f'{foreign_deps}/{source["path"]}')
 
-        module['build-options'] = build_options
+    return [f'{foreign_deps}/foreign_deps.json'] + sorted(patches)
 
-    rustup_json = f'rustup-{rust_version}.json'
 
-    with open(f'{MODULES}/{rustup_json}', 'w') as out:
-        print(f'Generating module: {rustup_json}...')
-        json.dump(generate_rustup(rust_version, RUSTUP_PATH), out, indent=4, sort_keys=False)
+def _get_input_files(args, manifest, manifest_root: str, releases: str, foreign_deps: str) -> list:
+    files = [
+        args.MANIFEST,
+        f'{manifest_root}/foreign.json',
+        f'{releases}/flutter/flutter-shared.sh.patch',
+        f'{releases}/flutter/flutter-pre-3_35-shared.sh.patch',
+    ] + _get_foreign_deps_files(foreign_deps, f'{manifest_root}/foreign.json') + sorted(glob.glob('*.offline.patch'))
 
-    return rust_version
+    for source in _get_app_sources(args, manifest):
+        if source.get('type') == 'git' and 'url' in source:
+            if str(source['url']).startswith(FLUTTER_URL) and 'tag' in source:
+                files.append(f'{releases}/flutter/{source["tag"]}')
+        elif 'path' in source or 'paths' in source:
+            files += list(source['paths']) if 'paths' in source else [source['path']]
 
+    return files
 
-def _generate_cargo_sources(module, cargo_locks: list, rust_version: str):
-    app = module['name']
-    cargo_paths = []
 
-    for path in cargo_locks:
-        cargo_paths.append(f'{build_path}/{app}/{path}/Cargo.lock')
+def _get_fingerprint(args, manifest, manifest_root: str, from_git_commit: Optional[str], releases: str, foreign_deps: str, resolved: dict) -> str:
+    refs = []
 
-    cargo_json = 'cargo.json'
-    module['sources'] += [f'{SOURCES}/{cargo_json}']
-    config_filename = 'config' if Version(rust_version) < Version('1.38.0') else 'config.toml'
+    for source in _get_app_sources(args, manifest):
+        if source.get('type') == 'git' and 'url' in source:
+            url = str(source['url'])
 
-    print(f'Generating source: {cargo_json}...', end='')
+            if 'commit' in source:
+                refs.append([url, str(source['commit'])])
+            else:
+                ref = source['tag'] if 'tag' in source else source.get('branch')
+                key = f'{url}#{ref}'
 
-    cargo_sources, deduped = asyncio.run(generate_cargo_sources(cargo_paths, config_filename))
+                if key not in resolved:
+                    resolved[key] = resolve_ref(url, ref)
 
-    with open(f'{SOURCES}/{cargo_json}', 'w') as out:
-        json.dump(cargo_sources, out, indent=4, sort_keys=False)
-        out.write('\n')
-        if deduped:
-            print(f' (deduped {deduped} entries)')
-        else:
-            print()
+                refs.append([url, ref, resolved[key]])
 
+    inputs = {
+        'version': __version__,
+        'args': {key: value for key, value in vars(args).items() if key not in UNFINGERPRINTED_ARGS},
+        'from-git': from_git_commit,
+        'refs': refs,
+        'files': hash_files(_get_input_files(args, manifest, manifest_root, releases, foreign_deps)),
+    }
 
-def _get_sdk_module(app: str, sdk_path: str, tag: str, releases: str):
-    flutter_patch = 'flutter/shared.sh.patch'
-    print(f'Generating patch: {flutter_patch}...')
-
-    if Version(tag.split('-')[0]) < Version('3.35.0'):
-        shutil.copyfile(f'{releases}/flutter/flutter-pre-3_35-shared.sh.patch', f'{PATCHES}/{flutter_patch}')
-    else:
-        shutil.copyfile(f'{releases}/flutter/flutter-shared.sh.patch', f'{PATCHES}/{flutter_patch}')
+    return get_fingerprint(inputs)
 
-    flutter_sdk_json = f'flutter-sdk-{tag}.json'
-    print(f'Generating module: {flutter_sdk_json}...')
 
-    if os.path.isfile(f'{releases}/flutter/{tag}/flutter-sdk.json'):
-        shutil.copyfile(f'{releases}/flutter/{tag}/flutter-sdk.json', f'{MODULES}/{flutter_sdk_json}')
-    else:
-        generated_sdk = generate_sdk(f'{build_path}/{app}/{sdk_path}', tag, '../patches/flutter')
+def _parse_arches(value: str) -> list:
+    arches = [arch for arch in value.split(',') if arch]
 
-        with open(f'{MODULES}/{flutter_sdk_json}', 'w') as out:
-            json.dump(generated_sdk, out, indent=4, sort_keys=False)
+    for arch in arches:
+        if arch not in ARCHES:
+            raise argparse.ArgumentTypeError(f'unsupported architecture {arch}, choose from {", ".join(ARCHES)}')
 
+    if not arches:
+        raise argparse.ArgumentTypeError('no architecture given')
 
-def _add_child_module(module, child_module):
-    if 'modules' in module:
-        if child_module not in module['modules']:
-            module['modules'] += [child_module]
-    else:
-        module['modules'] = [child_module]
+    return arches
 
 
 def main():
@@ -399,101 +269,219 @@ def main():
     parser.add_argument('--cargo-locks', metavar='PATHS', help='Comma separated list of Cargo.lock paths')
     parser.add_argument('--from-git', metavar='URL', required=False, help='Get input files from git repo')
     parser.add_argument('--from-git-branch', metavar='BRANCH', required=False, help='Branch to use in --from-git')
+    parser.add_argument('--no-discovery', action='store_true', help="Don't scan the pub cache for Cargo.lock files, cargokit build tools and download sites")
     parser.add_argument('--no-shallow-clone', action='store_true', help="Don't use shallow clones when mirroring git repos")
+    parser.add_argument('--sparse-clone', action='store_true', help='Only fetch the lockfiles, build inputs and patch targets of the app repo, using a partial sparse clone')
     parser.add_argument('--keep-build-dirs', action='store_true', help="Don't remove build directories after processing")
+    parser.add_argument('--reuse-build-dirs', action='store_true', help='Update existing build directories in place instead of cloning again')
+    parser.add_argument('--shard-sources', action='store_true', help='Split the generated sources in stable, canonically sorted shards')
+    parser.add_argument('--compact-sources', action='store_true', help='Fold the inline metadata of the dependencies into one script per generator, run by a single shell command')
+    parser.add_argument('--git-archives', action='store_true', help='Fetch cargo git dependencies hosted on GitHub, GitLab or Codeberg as commit archives instead of git mirrors')
+    parser.add_argument('--no-cache', action='store_true', help='Process the manifest even if the inputs are unchanged since the previous run')
+    parser.add_argument('--jobs', metavar='N', type=int, default=4, help='Number of generation stages to run concurrently')
+    parser.add_argument('--seed-state-dir', metavar='DIR', nargs='?', const='.flatpak-builder', help='Keep the artifacts downloaded while generating in the download cache of a flatpak-builder state dir, .flatpak-builder if no DIR is given')
+    parser.add_argument('--arches', metavar='ARCHES', type=_parse_arches, default=ARCHES, help=f'Comma separated list of architectures to generate sources for, {",".join(ARCHES)} by default')
+    parser.add_argument('--sdk-install', choices=SDK_INSTALLS.keys(), default=DEFAULT_SDK_INSTALL, help=f'How the flutter module installs the SDK in /var/lib, {DEFAULT_SDK_INSTALL} by default')
+    parser.add_argument('--sdk-source', choices=SDK_SOURCES, default=DEFAULT_SDK_SOURCE, help=f'Fetch the Flutter SDK as a git clone or as a commit archive with a git stub, {DEFAULT_SDK_SOURCE} by default')
+    parser.add_argument('--verify', action='store_true', help='Download all remote sources of the generated manifest and check their sha256')
+    parser.add_argument('--watch', action='store_true', help='Keep running and process the manifest again when one of its local inputs changes, implies --reuse-build-dirs')
+    parser.add_argument('--profile', metavar='FILE', nargs='?', const='-', help='Write a JSON summary of the time spent per stage, to stdout if no FILE is given')
+    parser.add_argument('--trace', metavar='FILE', help='Write the stage timings in Chrome trace event format')
+    http = parser.add_mutually_exclusive_group()
+    http.add_argument('--record-http', metavar='DIR', help='Record the HTTP responses in DIR, large bodies by their digest only')
+    http.add_argument('--replay-http', metavar='DIR', help='Serve the HTTP responses from a recording in DIR, without network access')
     parser.add_argument('--template', metavar='URL', required=False, help="Generate a template manifest for the given URL")
     parser.add_argument('--id', metavar='ID', help='App ID to use in the generated template')
     parser.add_argument('--command', metavar='CMD', help='Command to use in the generated template')
 
     args = parser.parse_args()
-    raw_url = None
+    profile = start_profiling() if args.profile or args.trace else None
+
+    if args.record_http:
+        http_client.start_recording(args.record_http)
+    elif args.replay_http:
+        http_client.start_replay(args.replay_http)
+
+    if args.watch:
+        args.reuse_build_dirs = True
+
+    try:
+        if args.watch:
+            _watch(args)
+        else:
+            _process(args)
+    except KeyboardInterrupt:
+        print()
+    finally:
+        if profile is not None:
+            if args.profile:
+                write_summary(profile, args.profile)
+            if args.trace:
+                write_trace(profile, args.trace)
+
+
+def _verify_sources(manifest_path: str, jobs: int):
+    sources = [(source['url'], source['sha256']) for source in get_remote_sources(manifest_path)]
+    print(f'Verifying {len(set(sources))} remote sources...')
+
+    with profiler.span('verify', 'stage'):
+        result = verify(sources, jobs, f'{fingerprint_path}/verified-sources.json')
 
+    for url, expected, actual in result.mismatches:
+        print(f'Error: sha256 mismatch for {url}, expected {expected}, got {actual}', file=sys.stderr)
+
+    for url, error in result.unreachable:
+        print(f'Error: Unable to fetch {url}: {error}', file=sys.stderr)
+
+    if result.mismatches or result.unreachable:
+        print(f'Verification failed: {len(result.mismatches)} mismatching, {len(result.unreachable)} unreachable', file=sys.stderr)
+        exit(1)
+
+    print(f'Verified {result.verified} sources, {result.cached} verified before')
+
+
+def _get_data_paths():
     if 'FLATPAK_FLUTTER_ROOT' in os.environ:
         parent = os.environ['FLATPAK_FLUTTER_ROOT']
     else:
         parent = str(Path(sys.argv[0]).parent)
 
-    releases_path = f'{parent}/releases'
-    foreign_deps_path = f'{parent}/foreign_deps'
+    return f'{parent}/releases', f'{parent}/foreign_deps'
+
+
+def _watch(args):
+    releases_path, foreign_deps_path = _get_data_paths()
+    files = [args.MANIFEST]
+    # The modules generated from the network are kept for the next run
+    cache = Cache()
+
+    while True:
+        try:
+            if os.path.isfile(args.MANIFEST):
+                manifest, manifest_root, _ = _get_manifest(args)
+                files = _get_input_files(args, manifest, manifest_root, releases_path, foreign_deps_path)
+        except Exception as error:
+            # Keep watching the previous inputs, the manifest may be saved halfway
+            print(f'Error: {error}', file=sys.stderr)
+
+        # Snapshot before processing, to also pick up changes made while processing
+        watcher = FileWatcher(files)
+
+        try:
+            _process(args, cache)
+        except SystemExit:
+            # The error is reported already, wait for the next change
+            pass
+        except Exception as error:
+            print(f'Error: {error}', file=sys.stderr)
+
+        print(f'Watching {len(files)} inputs for changes, press Ctrl+C to stop...')
+
+        try:
+            changed = watcher.wait()
+        finally:
+            watcher.close()
+
+        print(f'Changed: {", ".join(changed)}')
+
+
+def _get_options(args) -> Options:
+    releases_path, foreign_deps_path = _get_data_paths()
+
+    return Options(
+        app_module=args.app_module,
+        app_pubspec=args.app_pubspec,
+        extra_pubspecs=tuple(str(args.extra_pubspecs).split(',')) if args.extra_pubspecs is not None else (),
+        cargo_locks=tuple(str(args.cargo_locks).split(',')) if args.cargo_locks is not None else (),
+        discovery=not args.no_discovery,
+        shallow_clone=not args.no_shallow_clone,
+        sparse_clone=args.sparse_clone,
+        keep_build_dirs=args.keep_build_dirs,
+        reuse_build_dirs=args.reuse_build_dirs,
+        shard_sources=args.shard_sources,
+        compact_sources=args.compact_sources,
+        git_archives=args.git_archives,
+        jobs=args.jobs,
+        seed_state_dir=args.seed_state_dir,
+        arches=tuple(args.arches),
+        sdk_install=args.sdk_install,
+        sdk_source=args.sdk_source,
+        releases_path=releases_path,
+        foreign_deps_path=foreign_deps_path,
+    )
+
+
+def _process(args, cache: Optional[Cache] = None):
+    releases_path, foreign_deps_path = _get_data_paths()
+
+    from_git_commit = resolve_ref(args.from_git, args.from_git_branch) if args.from_git else None
+    fingerprint_cache = f'{fingerprint_path}/{Path(args.MANIFEST).name}.json'
+    resolved = {}
+
+    if not args.no_cache and os.path.isfile(args.MANIFEST):
+        manifest, manifest_root, suffix = _get_manifest(args)
+        fingerprint = _get_fingerprint(args, manifest, manifest_root, from_git_commit, releases_path, foreign_deps_path, resolved)
+
+        with profiler.span('fingerprint', 'cache') as info:
+            unchanged = is_unchanged(fingerprint_cache, fingerprint)
+            info['cache'] = 'hit' if unchanged else 'miss'
+
+        if unchanged:
+            print('Inputs unchanged since the previous run, keeping the generated files')
+
+            if args.verify:
+                app_id = manifest['app-id'] if 'app-id' in manifest else manifest.get('id', '')
+                _verify_sources(f'{app_id}{suffix}', args.jobs)
+
+            print('Done!')
+            return
 
     if args.from_git:
         _get_manifest_from_git(args.MANIFEST, args.from_git, args.from_git_branch)
 
     manifest, manifest_root, suffix = _get_manifest(args)
-    no_shallow = True if args.no_shallow_clone else False
-
-    app_id, app_module, app_pubspec, tag, sdk_path, build_id = fetch_flutter_app(
-        manifest,
-        args.app_module,
-        build_path,
-        releases_path,
-        args.app_pubspec,
-        no_shallow,
-    )
+    fingerprint = _get_fingerprint(args, manifest, manifest_root, from_git_commit, releases_path, foreign_deps_path, resolved)
+
+    try:
+        app_id, manifest, files = convert(manifest, '.', _get_options(args), cache, str(manifest_root))
+    except ConversionError as error:
+        for line in str(error).splitlines():
+            print(f'Error: {line}', file=sys.stderr)
+        exit(1)
 
-    if tag and sdk_path:
-        build_path_app = f'{build_path}/{app_module}'
-        _create_pub_cache(build_path_app, sdk_path, app_pubspec)
-
-        print(f'SDK path: {sdk_path}, tag: {tag}')
-    
-        full_pubspec_path = f'{build_path_app}/{app_pubspec}'
-        extra_pubspecs, cargo_locks, foreign = _handle_foreign_dependencies(
-            app_pubspec,
-            full_pubspec_path,
-            foreign_deps_path,
-            manifest_root,
-        )
-
-        if args.extra_pubspecs is not None:
-            extra_pubspecs += str(args.extra_pubspecs).split(',')
-        if args.cargo_locks is not None:
-            cargo_locks += str(args.cargo_locks).split(',')
-
-        os.makedirs(MODULES, exist_ok=True)
-        os.makedirs(SOURCES, exist_ok=True)
-        os.makedirs(f'{PATCHES}/flutter', exist_ok=True)
-
-        for module in manifest['modules']:
-            if 'name' in module and module['name'] == app_module:
-                _generate_pubspec_sources(module, app_pubspec, extra_pubspecs, foreign, sdk_path)
-                _get_sdk_module(app_module, sdk_path, tag, releases_path)
-
-                if len(cargo_locks):
-                    rust_version = _generate_rustup_module(module)
-                    _generate_cargo_sources(module, cargo_locks, rust_version)
-
-                module['sources'] += [f'{SOURCES}/pubspec.json']
-                _add_child_module(module, f'{MODULES}/flutter-sdk-{tag}.json')
-                break
-
-        # Write converted manifest to file
-        with open(f'{app_id}{suffix}', 'w') as output_stream:
-            source = raw_url if raw_url is not None else args.MANIFEST
-            prepend = f'''# DO NOT EDIT.
+    for path, contents in files.items():
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        with open(path, 'w') as output:
+            output.write(contents)
+
+    # Write converted manifest to file
+    with profiler.span('manifest', 'stage'), open(f'{app_id}{suffix}', 'w') as output_stream:
+        prepend = f'''# DO NOT EDIT.
 # Any changes will be overwritten.
 #
 # Generated by flatpak-flutter v{__version__}
-# Source: {source}
+# Source: {args.MANIFEST}
 #
 # Visit the project at https://github.com/TheAppgineer/flatpak-flutter
 
 '''
-            print(f'Generating manifest: {app_id}{suffix}...')
+        print(f'Generating manifest: {app_id}{suffix}...')
 
-            if suffix == '.json':
-                prepend = { '//': prepend.replace('\n', '.')}
-                prepend.update(manifest)
-                json.dump(prepend, output_stream, indent=4, sort_keys=False)
-            else:
-                output_stream.write(prepend)
-                yaml.dump(data=manifest, stream=output_stream, indent=2, sort_keys=False, Dumper=Dumper)
+        if suffix == '.json':
+            prepend = { '//': prepend.replace('\n', '.')}
+            prepend.update(manifest)
+            json.dump(prepend, output_stream, indent=4, sort_keys=False)
+        else:
+            output_stream.write(prepend)
+            yaml.dump(data=manifest, stream=output_stream, indent=2, sort_keys=False, Dumper=Dumper)
+
+    store(fingerprint_cache, fingerprint, [f'{app_id}{suffix}', 'generated'] + glob.glob('*.flutter.patch'))
 
-        if not args.keep_build_dirs:
-            shutil.rmtree(f'{build_path}/{app_module}-{build_id}')
-            os.remove(f'{build_path}/{app_module}')
+    if args.verify:
+        _verify_sources(f'{app_id}{suffix}', args.jobs)
 
-        print('Done!')
+    print('Done!')
 
 
 if __name__ == '__main__':
@@ -2,17 +2,39 @@ __license__ = 'MIT'
 import subprocess
 import yaml
 import glob
+import json
 import os
 import shutil
 import sys
 
-from git_actions.git_actions import fetch_repos, get_commit, get_tag
+from git_actions.git_actions import expand_sparse_repo, fetch_repos, fetch_sparse_repo, get_commit, get_tag, update_repos
 from pathlib import Path
+from profiler import profiler
 from typing import Optional
 
 
 FLUTTER_URL = 'https://github.com/flutter/flutter'
 
+# The files read from a sparse app repo: top-level files, locks and native build inputs, patch targets are added on demand
+SPARSE_PATTERNS = [
+    '/*',
+    '!/*/',
+    'pubspec.yaml',
+    'pubspec.lock',
+    'pubspec_overrides.yaml',
+    'l10n.yaml',
+    '*.arb',
+    'Cargo.toml',
+    'Cargo.lock',
+    'CMakeLists.txt',
+    '*.cmake',
+    '**/hook/*.dart',
+]
+
+
+class FetchError(Exception):
+    pass
+
 
 class Dumper(yaml.Dumper):
     def increase_indent(self, flow=False, *args, **kwargs):
@@ -99,9 +121,107 @@ def _process_build_commands(module, app_pubspec: str) -> str:
     return app_pubspec
 
 
-def _process_sources(module, fetch_path: str, releases_path: str, no_shallow: bool):
+def _get_build_ids(build_path_app: str) -> list[int]:
+    build_ids = []
+
+    for path in glob.glob(f'{build_path_app}-*'):
+        build_id = path.removeprefix(f'{build_path_app}-')
+
+        if build_id.isdigit() and os.path.isdir(path):
+            build_ids.append(int(build_id))
+
+    return sorted(build_ids)
+
+
+def _load_workspace(build_path_app: str, build_id: int) -> Optional[dict]:
+    workspace = f'{build_path_app}-{build_id}.json'
+
+    if os.path.isfile(workspace):
+        with open(workspace, 'r') as input:
+            return json.load(input)
+
+    return None
+
+
+def _save_workspace(build_path_app: str, build_id: int, repos: list, patches: list, sparse: bool):
+    with open(f'{build_path_app}-{build_id}.json', 'w') as output:
+        json.dump({'repos': repos, 'patches': patches, 'sparse': sparse}, output, indent=4)
+
+
+def _get_patch_targets(patch_path: str, strip_components: int) -> list:
+    targets = []
+
+    with open(patch_path, 'r') as input:
+        for line in input:
+            if line.startswith('--- ') or line.startswith('+++ '):
+                path = line[4:].split('\t')[0].strip()
+
+                if path != '/dev/null':
+                    targets.append('/'.join(path.split('/')[strip_components:]))
+
+    return list(dict.fromkeys(targets))
+
+
+def _revert_patches(fetch_path: str, patches: list) -> bool:
+    for dest, strip_components, contents in reversed(patches):
+        print(f'Revert patch: {dest}')
+        command = ['patch', '-R', '-s', f'-p{strip_components}', '-d', f'{fetch_path}/{dest}']
+        result = profiler.run('patch', command, input=contents.encode('utf-8'), stdout=subprocess.PIPE)
+
+        if result.returncode:
+            return False
+
+    return True
+
+
+def _collect_stale_workspaces(build_path_app: str, keep_id: int):
+    for build_id in _get_build_ids(build_path_app):
+        if build_id != keep_id:
+            print(f'Removing stale build directory: {build_path_app}-{build_id}')
+            shutil.rmtree(f'{build_path_app}-{build_id}')
+
+    for workspace in glob.glob(f'{build_path_app}-*.json'):
+        if workspace != f'{build_path_app}-{keep_id}.json':
+            os.remove(workspace)
+
+
+def _expand_patch_targets(sources: list, fetch_path: str, root: str, release_patches: dict):
+    patterns = []
+
+    for source in sources:
+        if source.get('type') == 'patch' and ('path' in source or 'paths' in source):
+            paths = list(source['paths']) if 'paths' in source else [source['path']]
+            strip_components = source['strip-components'] if 'strip-components' in source else 1
+            dest = source['dest'] if 'dest' in source else '.'
+
+            for path in paths:
+                for target in _get_patch_targets(release_patches.get(path, f'{root}/{path}'), strip_components):
+                    patterns.append(f'/{os.path.normpath(f"{dest}/{target}")}')
+
+    if patterns:
+        expand_sparse_repo(fetch_path, patterns)
+
+
+def _select_workspace(build_path_app: str, repos: list, reuse: bool, sparse: bool) -> tuple[int, bool]:
+    build_ids = _get_build_ids(build_path_app)
+
+    if reuse:
+        for build_id in reversed(build_ids):
+            workspace = _load_workspace(build_path_app, build_id)
+
+            if workspace is not None and workspace['repos'] == repos and workspace.get('sparse', False) == sparse:
+                if _revert_patches(f'{build_path_app}-{build_id}', workspace['patches']):
+                    return build_id, True
+
+                print(f'Warning: Unable to revert patches in {build_path_app}-{build_id}, cloning again', file=sys.stderr)
+
+    return build_ids[-1] + 1 if build_ids else 1, False
+
+
+def _process_sources(module, build_path_app: str, releases_path: str, no_shallow: bool, reuse: bool, sparse: bool, root: str):
     idxs = []
     repos = []
+    patches = []
     tag = None
     sdk_path = None
     sources = module['sources'] if 'sources' in module else []
@@ -122,11 +242,8 @@ def _process_sources(module, fetch_path: str, releases_path: str, no_shallow: bo
                 shallow = False if no_shallow or 'disable-shallow-clone' in source else True
                 recursive = False if 'disable-submodules' in source else True
 
-                if 'dest' in source:
-                    dest = str(source['dest'])
-                    repos.append((source['url'], ref, f'{fetch_path}/{dest}', shallow, recursive))
-                else:
-                    repos.append((source['url'], ref, fetch_path, shallow, recursive))
+                dest = str(source['dest']) if 'dest' in source else '.'
+                repos.append([source['url'], ref, dest, shallow, recursive])
 
                 if str(source['url']).startswith(FLUTTER_URL) and 'tag' in source:
                     idxs.append(idx)
@@ -136,7 +253,25 @@ def _process_sources(module, fetch_path: str, releases_path: str, no_shallow: bo
             if source['type'] == 'dir' and 'path' in source:
                 print(f'Warning: Skipping dir: {source["path"]}', file=sys.stderr)
 
-    fetch_repos(repos)
+    build_id, reused = _select_workspace(build_path_app, repos, reuse, sparse)
+    fetch_path = f'{build_path_app}-{build_id}'
+    fetch_path_repos = [
+        (url, ref, fetch_path if dest == '.' else f'{fetch_path}/{dest}', shallow, recursive)
+        for url, ref, dest, shallow, recursive in repos
+    ]
+    sparse_repos = [repo for repo in fetch_path_repos if sparse and repo[2] == fetch_path]
+    fetch_path_repos = [repo for repo in fetch_path_repos if repo not in sparse_repos]
+
+    with profiler.span('workspace', 'cache', cache='hit' if reused else 'miss'):
+        # The app repo goes first, the other repos are fetched into its tree
+        for url, ref, path, shallow, recursive in sparse_repos:
+            fetch_sparse_repo(url, ref, path, shallow, recursive, SPARSE_PATTERNS)
+
+        if reused:
+            print(f'Reusing build directory: {fetch_path}')
+            update_repos(fetch_path_repos)
+        else:
+            fetch_repos(fetch_path_repos)
 
     gitmodules = f'{fetch_path}/.gitmodules'
 
@@ -146,8 +281,11 @@ def _process_sources(module, fetch_path: str, releases_path: str, no_shallow: bo
         if sdk_path:
             tag = get_tag(f'{fetch_path}/{sdk_path}')
 
-    for patch in glob.glob(f'{releases_path}/{tag}/*.flutter.patch'):
-        shutil.copyfile(patch, Path(patch).name)
+    # The release patches are read from the catalog, writing them next to the manifest is left to the caller
+    release_patches = {Path(patch).name: patch for patch in glob.glob(f'{releases_path}/flutter/{tag}/*.flutter.patch')}
+
+    if sparse:
+        _expand_patch_targets(sources, fetch_path, root, release_patches)
 
     # With the repos fetched, any file access can be performed
     for source in sources:
@@ -167,24 +305,32 @@ def _process_sources(module, fetch_path: str, releases_path: str, no_shallow: bo
                         if '.flutter.patch' in str(path):
                             idxs.append(idx)
 
+                        patch_path = release_patches.get(path, f'{root}/{path}')
                         print(f'Apply patch: {path}')
-                        command = f'(cd {dest} && patch -p{strip_components}) < {path}'
-                        subprocess.run([command], shell=True, check=True)
+                        command = f'(cd {dest} && patch -p{strip_components}) < {patch_path}'
+                        profiler.run('patch', [command], shell=True, check=True)
+
+                        with open(patch_path, 'r') as input:
+                            patches.append([os.path.relpath(dest, fetch_path), strip_components, input.read()])
             elif type == 'git' and 'commit' not in source:
                 source['commit'] = get_commit(dest)
 
     for idx in reversed(idxs):
         del sources[idx]
 
-    for patch in glob.glob('*.offline.patch'):
+    for patch in sorted(glob.glob(f'{root}/*.offline.patch')):
         sources += [
             {
                 'type': 'patch',
-                'path': patch
+                'path': Path(patch).name
             }
         ]
 
-    return tag, sdk_path
+    if reuse:
+        _save_workspace(build_path_app, build_id, repos, patches, sparse)
+        _collect_stale_workspaces(build_path_app, build_id)
+
+    return tag, sdk_path, build_id
 
 
 def fetch_flutter_app(
@@ -194,33 +340,35 @@ def fetch_flutter_app(
     releases_path: str,
     app_pubspec: str,
     no_shallow: bool,
+    reuse: bool = False,
+    root: str = '.',
+    sparse: bool = False,
 ):
+    # Paths of local sources are relative to root
     if 'app-id' in manifest:
         app_id = 'app-id'
     elif 'id' in manifest:
         app_id = 'id'
     else:
-        exit(1)
+        raise FetchError('No app-id found in the manifest')
 
     app = app_module if app_module is not None else str(manifest[app_id]).split('.')[-1]
 
     if not 'modules' in manifest:
-        exit(1)
+        raise FetchError('No modules found in the manifest')
 
     for module in manifest['modules']:
         if not 'name' in module or str(module['name']).lower() != app.lower():
             continue
 
         if not 'buildsystem' in module or module['buildsystem'] != 'simple':
-            print('Error: Only the simple build system is supported', file=sys.stderr)
-            exit(1)
+            raise FetchError('Only the simple build system is supported')
 
         app_pubspec = _process_build_commands(module, app_pubspec)
 
         app_module = app_module if app_module is not None else str(module['name'])
         build_path_app = f'{build_path}/{app_module}'
-        build_id = len(glob.glob(f'{build_path_app}-*')) + 1
-        tag, sdk_path = _process_sources(module, f'{build_path_app}-{build_id}', releases_path, no_shallow)
+        tag, sdk_path, build_id = _process_sources(module, build_path_app, releases_path, no_shallow, reuse, sparse, root)
         _process_build_options(module, sdk_path)
 
         options = [f'cd {build_path} && ln -snf {app_module}-{build_id} {app_module}']
@@ -228,6 +376,7 @@ def fetch_flutter_app(
 
         return str(manifest[app_id]), app_module, app_pubspec, tag, sdk_path, build_id
     else:
-        print(f'Error: No module named {app} found!', file=sys.stderr)
-        print('Error: Specify the app module using the --app-module command line parameter', file=sys.stderr)
-        exit(1)
+        raise FetchError(
+            f'No module named {app} found!\n'
+            'Specify the app module using the --app-module command line parameter'
+        )
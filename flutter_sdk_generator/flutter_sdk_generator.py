@@ -3,29 +3,71 @@
 __license__ = 'MIT'
 import json
 import argparse
-import hashlib
-import urllib.request
+import glob
+import os
+import shutil
+import sys
 
+from download_cache import download_cache
 from git_actions.git_actions import get_commit
+from git_archives.git_archives import get_archive_url
+from http_client import http_client
+from manifest_sources.manifest_sources import ARCHES, filter_arches
 from packaging.version import Version
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
 
 _FlatpakSourceType = Dict[str, Any]
 
+# Ways to install the SDK in /var/lib, move is a rename when the build dir is on the same mount
+SDK_INSTALLS = {
+    'move': 'mkdir -p /var/lib && mv flutter /var/lib',
+    'reflink': 'mkdir -p /var/lib && cp -r --reflink=auto flutter /var/lib',
+    'copy': 'mkdir -p /var/lib && cp -r flutter /var/lib',
+}
+DEFAULT_SDK_INSTALL = 'move'
 
-def _get_remote_sha256(url: str) -> str:
+# The archive variant avoids mirroring the flutter repo, falling back to git for non archivable sources
+SDK_SOURCES = ['git', 'archive']
+DEFAULT_SDK_SOURCE = 'git'
+
+# Shipped next to flutter-sdk.json in the release catalog
+TOOLS_LOCK = 'flutter_tools.pubspec.lock'
+FLUTTER_RAW_URL = 'https://raw.githubusercontent.com/flutter/flutter'
+
+
+def _get_remote_sha256(url: str, state_dir: Optional[str]) -> str:
     print(f'Getting sha256 of {url}...')
-    sha256 = hashlib.sha256()
 
-    with urllib.request.urlopen(url) as response:
-        data = response.read()
-        sha256.update(data)
+    # The artifact is downloaded anyway, keep it for flatpak-builder when requested
+    if state_dir is not None:
+        return download_cache.download(state_dir, url)
+
+    return http_client.get_sha256(url)
+
 
-    return sha256.hexdigest()
+def _add_sha256(source: _FlatpakSourceType, sha256: str) -> _FlatpakSourceType:
+    # Keeps the sha256 next to the url
+    result = {}
 
+    for key, value in source.items():
+        result[key] = value
 
-def generate_sdk(sdk_path: str, tag: str, patch_path: str) -> _FlatpakSourceType:
+        if key == 'url':
+            result['sha256'] = sha256
+
+    return result
+
+
+def generate_sdk(
+    sdk_path: str,
+    tag: str,
+    patch_path: str,
+    state_dir: Optional[str] = None,
+    arches: List[str] = ARCHES,
+    install: str = DEFAULT_SDK_INSTALL,
+    source: str = DEFAULT_SDK_SOURCE,
+) -> _FlatpakSourceType:
     sdk_commit = get_commit(sdk_path)
     engine = open(f'{sdk_path}/bin/internal/engine.version', 'r').readline().strip()
     gradle_wrapper = open(f'{sdk_path}/bin/internal/gradle_wrapper.version', 'r').readline().strip()
@@ -64,7 +106,6 @@ def generate_sdk(sdk_path: str, tag: str, patch_path: str) -> _FlatpakSourceType
                 'x86_64'
             ],
             'url': dart_sdk_x64,
-            'sha256': _get_remote_sha256(dart_sdk_x64),
             'strip-components': 0,
             'dest': 'flutter/bin/cache'
         },
@@ -74,45 +115,38 @@ def generate_sdk(sdk_path: str, tag: str, patch_path: str) -> _FlatpakSourceType
                 'aarch64'
             ],
             'url': dart_sdk_arm64,
-            'sha256': _get_remote_sha256(dart_sdk_arm64),
             'strip-components': 0,
             'dest': 'flutter/bin/cache'
         },
         {
             'type': 'archive',
             'url': material_fonts,
-            'sha256': _get_remote_sha256(material_fonts),
             'dest': 'flutter/bin/cache/artifacts/material_fonts'
         },
         {
             'type': 'archive',
             'url': gradle_wrapper,
-            'sha256': _get_remote_sha256(gradle_wrapper),
             'strip-components': 0,
             'dest': 'flutter/bin/cache/artifacts/gradle_wrapper'
         },
         {
             'type': 'archive',
             'url': sky_engine,
-            'sha256': _get_remote_sha256(sky_engine),
             'dest': 'flutter/bin/cache/pkg/sky_engine'
         },
         {
             'type': 'archive',
             'url': flutter_gpu,
-            'sha256': _get_remote_sha256(flutter_gpu),
             'dest': 'flutter/bin/cache/pkg/flutter_gpu'
         },
         {
             'type': 'archive',
             'url': flutter_patched_sdk,
-            'sha256': _get_remote_sha256(flutter_patched_sdk),
             'dest': 'flutter/bin/cache/artifacts/engine/common/flutter_patched_sdk'
         },
         {
             'type': 'archive',
             'url': flutter_patched_sdk_product,
-            'sha256': _get_remote_sha256(flutter_patched_sdk_product),
             'dest': 'flutter/bin/cache/artifacts/engine/common/flutter_patched_sdk_product'
         },
         {
@@ -121,7 +155,6 @@ def generate_sdk(sdk_path: str, tag: str, patch_path: str) -> _FlatpakSourceType
                 'x86_64'
             ],
             'url': artifacts_x64,
-            'sha256': _get_remote_sha256(artifacts_x64),
             'strip-components': 0,
             'dest': 'flutter/bin/cache/artifacts/engine/linux-x64'
         },
@@ -131,7 +164,6 @@ def generate_sdk(sdk_path: str, tag: str, patch_path: str) -> _FlatpakSourceType
                 'x86_64'
             ],
             'url': font_subset_x64,
-            'sha256': _get_remote_sha256(font_subset_x64),
             'dest': 'flutter/bin/cache/artifacts/engine/linux-x64'
         },
         {
@@ -140,7 +172,6 @@ def generate_sdk(sdk_path: str, tag: str, patch_path: str) -> _FlatpakSourceType
                 'x86_64'
             ],
             'url': flutter_gtk_x64_profile,
-            'sha256': _get_remote_sha256(flutter_gtk_x64_profile),
             'strip-components': 0,
             'dest': 'flutter/bin/cache/artifacts/engine/linux-x64-profile'
         },
@@ -150,7 +181,6 @@ def generate_sdk(sdk_path: str, tag: str, patch_path: str) -> _FlatpakSourceType
                 'x86_64'
             ],
             'url': flutter_gtk_x64_release,
-            'sha256': _get_remote_sha256(flutter_gtk_x64_release),
             'strip-components': 0,
             'dest': 'flutter/bin/cache/artifacts/engine/linux-x64-release'
         },
@@ -160,7 +190,6 @@ def generate_sdk(sdk_path: str, tag: str, patch_path: str) -> _FlatpakSourceType
                 'aarch64'
             ],
             'url': artifacts_arm64,
-            'sha256': _get_remote_sha256(artifacts_arm64),
             'strip-components': 0,
             'dest': 'flutter/bin/cache/artifacts/engine/linux-arm64'
         },
@@ -170,7 +199,6 @@ def generate_sdk(sdk_path: str, tag: str, patch_path: str) -> _FlatpakSourceType
                 'aarch64'
             ],
             'url': font_subset_arm64,
-            'sha256': _get_remote_sha256(font_subset_arm64),
             'dest': 'flutter/bin/cache/artifacts/engine/linux-arm64'
         },
         {
@@ -179,7 +207,6 @@ def generate_sdk(sdk_path: str, tag: str, patch_path: str) -> _FlatpakSourceType
                 'aarch64'
             ],
             'url': flutter_gtk_arm64_profile,
-            'sha256': _get_remote_sha256(flutter_gtk_arm64_profile),
             'strip-components': 0,
             'dest': 'flutter/bin/cache/artifacts/engine/linux-arm64-profile'
         },
@@ -189,7 +216,6 @@ def generate_sdk(sdk_path: str, tag: str, patch_path: str) -> _FlatpakSourceType
                 'aarch64'
             ],
             'url': flutter_gtk_arm64_release,
-            'sha256': _get_remote_sha256(flutter_gtk_arm64_release),
             'strip-components': 0,
             'dest': 'flutter/bin/cache/artifacts/engine/linux-arm64-release'
         },
@@ -213,12 +239,17 @@ def generate_sdk(sdk_path: str, tag: str, patch_path: str) -> _FlatpakSourceType
             {
                 'type': 'file',
                 'url': engine_stamp,
-                'sha256': _get_remote_sha256(engine_stamp),
                 'dest': 'flutter/bin/cache'
             }
         ]
 
-    return {
+    # Only the artifacts of the selected architectures are hashed
+    sources = [
+        _add_sha256(source, _get_remote_sha256(source['url'], state_dir)) if source['type'] in ['archive', 'file'] else source
+        for source in filter_arches(sources, arches)
+    ]
+
+    module = {
         'name': 'flutter',
         'buildsystem': 'simple',
         'build-commands': [
@@ -229,29 +260,127 @@ def generate_sdk(sdk_path: str, tag: str, patch_path: str) -> _FlatpakSourceType
             'cp flutter/bin/internal/engine.version flutter/bin/cache/flutter_sdk.stamp',
             'cp flutter/bin/internal/engine.version flutter/bin/cache/font-subset.stamp',
             'cp flutter/bin/internal/engine.version flutter/bin/cache/linux-sdk.stamp',
-            'mkdir -p /var/lib && cp -r flutter /var/lib'
+            SDK_INSTALLS[install]
         ],
         'sources': sources
     }
+    set_sdk_source(module, source, state_dir)
+
+    return module
+
+
+def set_sdk_install(module: _FlatpakSourceType, install: str):
+    module['build-commands'] = [
+        SDK_INSTALLS[install] if command in SDK_INSTALLS.values() else command
+        for command in module['build-commands']
+    ]
+
+
+def set_sdk_source(module: _FlatpakSourceType, source: str, state_dir: Optional[str] = None):
+    if source != 'archive':
+        return
+
+    for idx, sdk_source in enumerate(module['sources']):
+        if sdk_source['type'] != 'git' or sdk_source.get('dest') != 'flutter':
+            continue
+
+        tag = sdk_source['tag']
+        url = get_archive_url(sdk_source['url'], sdk_source['commit'])
+
+        if url is None:
+            return
+
+        module['sources'][idx:idx + 1] = [
+            {
+                'type': 'archive',
+                'archive-type': 'tar-gzip',
+                'url': url,
+                'sha256': _get_remote_sha256(url, state_dir),
+                'dest': 'flutter'
+            },
+            {
+                'type': 'inline',
+                'contents': tag,
+                'dest': 'flutter',
+                'dest-filename': 'version'
+            }
+        ]
+        # The tool derives its version from git, a tagged commit of the extracted tree stands in for the clone
+        module['build-commands'].insert(
+            0,
+            f'cd flutter && git init -q && git add -A && '
+            f'git -c user.name=flatpak -c user.email=flatpak@localhost commit -q -m {tag} && git tag {tag}'
+        )
+        return
+
+
+def get_missing_tools_locks(releases_path: str) -> List[str]:
+    # The catalog tags that have a module but no flutter_tools lock
+    return [
+        os.path.basename(os.path.dirname(module_path))
+        for module_path in sorted(glob.glob(f'{releases_path}/flutter/*/flutter-sdk.json'))
+        if not os.path.isfile(f'{os.path.dirname(module_path)}/{TOOLS_LOCK}')
+    ]
+
+
+def update_tools_locks(releases_path: str):
+    for tag in get_missing_tools_locks(releases_path):
+        tag_path = f'{releases_path}/flutter/{tag}'
+        module_path = f'{tag_path}/flutter-sdk.json'
+
+        with open(module_path, 'r') as input:
+            module = json.load(input)
+
+        for source in module['sources']:
+            if source['type'] == 'git' and source.get('dest') == 'flutter':
+                url = f'{FLUTTER_RAW_URL}/{source["commit"]}/packages/flutter_tools/pubspec.lock'
+                print(f'Fetching {url}...')
+
+                with open(f'{tag_path}/{TOOLS_LOCK}', 'wb') as out:
+                    out.write(http_client.fetch(url))
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('sdk_path', help='Path to the Flutter SDK')
+    parser.add_argument('sdk_path', nargs='?', help='Path to the Flutter SDK')
     parser.add_argument('-o', '--output', required=False, help='Where to write generated sources')
+    parser.add_argument('--install', choices=SDK_INSTALLS.keys(), default=DEFAULT_SDK_INSTALL, help='How the SDK is installed in /var/lib')
+    parser.add_argument('--source', choices=SDK_SOURCES, default=DEFAULT_SDK_SOURCE, help='Fetch the SDK as a git clone or as a commit archive')
+    parser.add_argument('--tools-lock', action='store_true', help=f'Also write the flutter_tools pubspec.lock next to the output as {TOOLS_LOCK}, like in the release catalog')
+    parser.add_argument('--update-tools-locks', metavar='RELEASES', help='Fetch the missing flutter_tools locks of the release catalog in RELEASES and exit')
+    parser.add_argument('--check-tools-locks', metavar='RELEASES', help='Report the tags of the release catalog in RELEASES without a flutter_tools lock and exit')
+    parser.add_argument('--arches', metavar='ARCHES', default=','.join(ARCHES), help='Comma separated list of architectures to generate sources for')
     args = parser.parse_args()
 
+    if args.update_tools_locks is not None:
+        update_tools_locks(args.update_tools_locks)
+        return
+
+    if args.check_tools_locks is not None:
+        missing = get_missing_tools_locks(args.check_tools_locks)
+
+        for tag in missing:
+            print(f'Missing {TOOLS_LOCK}: {tag}', file=sys.stderr)
+
+        exit(1 if missing else 0)
+
+    if args.sdk_path is None:
+        parser.error('the following arguments are required: sdk_path')
+
     if args.output is not None:
         outfile = args.output
     else:
         outfile = 'flutter-sdk.json'
 
     tag = open(f'{args.sdk_path}/version', 'r').readline().strip()
-    generated_sdk = generate_sdk(args.sdk_path, tag)
+    generated_sdk = generate_sdk(args.sdk_path, tag, arches=args.arches.split(','), install=args.install, source=args.source)
 
     with open(outfile, 'w') as out:
         json.dump(generated_sdk, out, indent=4, sort_keys=False)
 
+    if args.tools_lock:
+        shutil.copyfile(f'{args.sdk_path}/packages/flutter_tools/pubspec.lock', os.path.join(os.path.dirname(outfile), TOOLS_LOCK))
+
 
 if __name__ == '__main__':
     main()
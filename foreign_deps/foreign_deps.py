@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+__license__ = 'MIT'
+import argparse
+import bisect
+import copy
+import json
+import os
+import pickle
+import sys
+
+from packaging.version import InvalidVersion, Version
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+INDEX_VERSION = 1
+
+_CompiledType = Dict[str, Tuple[List[Version], List[Any]]]
+
+
+class ForeignDepsIndex(NamedTuple):
+    packages: _CompiledType
+    local: Dict[str, Any]
+
+    def resolve(self, name: str, version: str) -> Optional[Any]:
+        if name not in self.packages:
+            return None
+
+        versions, foreign_deps = self.packages[name]
+        # Use the latest entry not newer than the version in use, or else the oldest entry
+        idx = bisect.bisect_right(versions, Version(version)) - 1
+
+        return copy.deepcopy(foreign_deps[max(idx, 0)])
+
+    def get_local(self) -> List[Any]:
+        return copy.deepcopy(list(self.local.values()))
+
+
+_compiled: Dict[Tuple[str, int, int, int, int], _CompiledType] = {}
+
+
+def _compile(foreign_deps: Dict[str, Any]) -> _CompiledType:
+    compiled: _CompiledType = {}
+
+    for name, entries in foreign_deps.items():
+        parsed = sorted(((Version(version), entry) for version, entry in entries.items()), key=lambda item: item[0])
+        compiled[name] = ([version for version, _ in parsed], [entry for _, entry in parsed])
+
+    return compiled
+
+
+def _get_cache_path() -> str:
+    cache_dir = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+
+    return os.path.join(cache_dir, 'flatpak-flutter', 'foreign-deps-index.pickle')
+
+
+def _load_compiled(foreign_deps_json: str) -> _CompiledType:
+    path = os.path.abspath(foreign_deps_json)
+    stat = os.stat(path)
+    # A change of this module invalidates the cache as well, the pickle refers to its classes
+    module_stat = os.stat(__file__)
+    key = (path, stat.st_mtime_ns, stat.st_size, INDEX_VERSION, module_stat.st_mtime_ns)
+
+    if key in _compiled:
+        return _compiled[key]
+
+    cache_path = _get_cache_path()
+
+    try:
+        with open(cache_path, 'rb') as input:
+            cache = pickle.load(input)
+
+        if cache['version'] == INDEX_VERSION and tuple(cache['key']) == key:
+            _compiled[key] = cache['packages']
+            return cache['packages']
+    except Exception:
+        # A stale or corrupt cache is rebuilt
+        pass
+
+    with open(path, 'r') as input:
+        compiled = _compile(json.load(input))
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+        # Write and rename, concurrent runs can share the cache
+        with open(f'{cache_path}.{os.getpid()}', 'wb') as output:
+            pickle.dump({'version': INDEX_VERSION, 'key': key, 'packages': compiled}, output)
+
+        os.replace(f'{cache_path}.{os.getpid()}', cache_path)
+    except OSError:
+        # The on disk cache is an optimization only
+        pass
+
+    _compiled[key] = compiled
+
+    return compiled
+
+
+def load_index(foreign_deps_json: str, foreign_json: Optional[str] = None) -> ForeignDepsIndex:
+    compiled = _load_compiled(foreign_deps_json)
+    local = {}
+
+    if foreign_json is not None and os.path.isfile(foreign_json):
+        with open(foreign_json, 'r') as input:
+            local = json.load(input)
+
+    # Local definitions override the known foreign dependencies, regardless of version
+    packages = {name: entry for name, entry in compiled.items() if name not in local}
+
+    return ForeignDepsIndex(packages, local)
+
+
+def validate(foreign_deps_json: str) -> List[str]:
+    errors = []
+
+    with open(foreign_deps_json, 'r') as input:
+        foreign_deps = json.load(input)
+
+    for name, entries in foreign_deps.items():
+        if not isinstance(entries, dict) or not entries:
+            errors.append(f'{name}: expected a non empty object of versions')
+            continue
+
+        previous = None
+
+        for version in entries.keys():
+            try:
+                parsed = Version(version)
+            except InvalidVersion:
+                errors.append(f'{name}: unparsable version {version}')
+                continue
+
+            if previous is not None and parsed <= previous:
+                errors.append(f'{name}: version {version} is not sorted after {previous}')
+
+            previous = parsed
+
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('foreign_deps', nargs='?', default=f'{os.path.dirname(__file__)}/foreign_deps.json', help='Path to foreign_deps.json')
+    args = parser.parse_args()
+
+    errors = validate(args.foreign_deps)
+
+    for error in errors:
+        print(f'Error: {error}', file=sys.stderr)
+
+    if errors:
+        exit(1)
+
+    print(f'{args.foreign_deps} is valid')
+
+
+if __name__ == '__main__':
+    main()
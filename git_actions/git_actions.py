@@ -1,6 +1,8 @@
+import os
 import subprocess
 
 from packaging.version import Version
+from profiler import profiler
 
 
 def _get_git_version() -> Version:
@@ -34,23 +36,97 @@ def fetch_repos(repos: list):
             if _get_git_version() >= Version('2.49.0'):
                 # Use the revision option
                 options[options.index('--branch')] = '--revision'
-                subprocess.run(options, check=True)
+                profiler.run('git clone', options, check=True)
             else:
                 # Use a full clone as a last resort
                 clone = 'git clone --recursive' if recursive else 'git clone'
                 command = [f'{clone} -c advice.detachedHead=false {url} {path} && cd {path} && git reset --hard {ref}']
-                subprocess.run(command, check=True, shell=True)
+                profiler.run('git clone', command, check=True, shell=True)
         except (TypeError, ValueError):
-            subprocess.run(options, check=True)
+            profiler.run('git clone', options, check=True)
+
+
+def update_repos(repos: list):
+    def by_path_depth(fetch_repo):
+        return len(str(fetch_repo[2]).split('/'))
+
+    repos.sort(key=by_path_depth)
+
+    for url, ref, path, shallow, recursive in repos:
+        if not os.path.exists(f'{path}/.git'):
+            fetch_repos([(url, ref, path, shallow, recursive)])
+            continue
+
+        options = ['git', '-C', path, 'fetch', url]
+        if shallow:
+            options += ['--depth', '1']
+        options += [ref if ref else 'HEAD']
+
+        profiler.run('git fetch', options, check=True)
+        profiler.run('git checkout', ['git', '-C', path, '-c', 'advice.detachedHead=false', 'checkout', '-q', '--force', 'FETCH_HEAD'], check=True)
+
+        if recursive:
+            options = ['git', '-C', path, 'submodule', 'update', '--init', '--recursive', '--force']
+            if shallow:
+                options += ['--depth', '1']
+
+            profiler.run('git submodule', options, check=True)
+
+
+def fetch_sparse_repo(url: str, ref: str, path: str, shallow: bool, recursive: bool, patterns: list):
+    # Blobs are fetched on demand, for the paths matching the sparse patterns only
+    if not os.path.exists(f'{path}/.git'):
+        profiler.run('git init', ['git', 'init', '-q', path], check=True)
+        profiler.run('git remote', ['git', '-C', path, 'remote', 'add', 'origin', url], check=True)
+        profiler.run('git sparse-checkout', ['git', '-C', path, 'sparse-checkout', 'set', '--no-cone'] + patterns, check=True)
+
+    options = ['git', '-C', path, 'fetch', '-q', '--filter=blob:none', 'origin']
+    if shallow:
+        options += ['--depth', '1']
+    options += [ref if ref else 'HEAD']
+
+    profiler.run('git fetch', options, check=True)
+    profiler.run('git checkout', ['git', '-C', path, '-c', 'advice.detachedHead=false', 'checkout', '-q', '--force', 'FETCH_HEAD'], check=True)
+
+    if recursive and os.path.isfile(f'{path}/.gitmodules'):
+        options = ['git', '-C', path, 'config', '-f', '.gitmodules', '--get-regexp', r'^submodule\..*\.path$']
+        stdout = profiler.run('git config', options, stdout=subprocess.PIPE).stdout
+
+        # output: submodule.<name>.path <path> per submodule
+        submodules = [f'/{line.split(" ", 1)[1]}/' for line in stdout.decode('utf-8').strip().splitlines()]
+
+        if submodules:
+            expand_sparse_repo(path, submodules)
+
+            options = ['git', '-C', path, 'submodule', 'update', '--init', '--recursive', '--force']
+            if shallow:
+                options += ['--depth', '1']
+
+            profiler.run('git submodule', options, check=True)
+
+
+def expand_sparse_repo(path: str, patterns: list):
+    result = subprocess.run(['git', '-C', path, 'config', '--bool', 'core.sparseCheckout'], stdout=subprocess.PIPE)
+
+    if result.stdout.decode('utf-8').strip() == 'true':
+        profiler.run('git sparse-checkout', ['git', '-C', path, 'sparse-checkout', 'add'] + patterns, check=True)
+
+
+def resolve_ref(url: str, ref: str) -> str:
+    options = ['git', 'ls-remote', url, ref if ref else 'HEAD']
+    stdout = profiler.run('git ls-remote', options, stdout=subprocess.PIPE, check=True).stdout
+
+    # output: <commit>\t<ref> per matching ref
+    return ','.join(line.split('\t')[0] for line in stdout.decode('utf-8').strip().splitlines())
 
 
 def get_commit(path: str) -> str:
-    stdout = subprocess.run([f'git -C {path} rev-parse HEAD'], stdout=subprocess.PIPE, shell=True, check=True).stdout
+    stdout = profiler.run('git rev-parse', [f'git -C {path} rev-parse HEAD'], stdout=subprocess.PIPE, shell=True, check=True).stdout
 
     return stdout.decode('utf-8').strip()
 
 def get_tag(path: str) -> str:
     command = [f'cd {path} && git fetch && git tag --points-at HEAD']
-    result = subprocess.run(command, stdout=subprocess.PIPE, shell=True, check=True)
+    result = profiler.run('git fetch', command, stdout=subprocess.PIPE, shell=True, check=True)
 
     return result.stdout.decode('utf-8').strip()
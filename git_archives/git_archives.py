@@ -0,0 +1,40 @@
+__license__ = 'MIT'
+from http_client import http_client
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
+
+# Hosts that serve a tarball of any commit, by the URL of the repo
+ARCHIVE_URLS = {
+    'github.com': '{repo}/archive/{commit}.tar.gz',
+    'gitlab.com': '{repo}/-/archive/{commit}/{name}-{commit}.tar.gz',
+    'codeberg.org': '{repo}/archive/{commit}.tar.gz',
+}
+
+_FlatpakSourceType = Dict[str, Any]
+
+
+def get_archive_url(url: str, commit: str) -> Optional[str]:
+    parts = urlsplit(url.removeprefix('git+'))
+    host = parts.netloc.lower()
+    path = parts.path.rstrip('/').removesuffix('.git')
+
+    if parts.scheme not in ['http', 'https'] or host not in ARCHIVE_URLS or path.count('/') < 2 or len(commit) != 40:
+        return None
+
+    return ARCHIVE_URLS[host].format(repo=f'https://{host}{path}', name=path.split('/')[-1], commit=commit)
+
+
+def get_archive_source(url: str, commit: str, dest: str) -> Optional[_FlatpakSourceType]:
+    # Returns None for hosts without commit archives, those are fetched with git
+    archive_url = get_archive_url(url, commit)
+
+    if archive_url is None:
+        return None
+
+    return {
+        'type': 'archive',
+        'archive-type': 'tar-gzip',
+        'url': archive_url,
+        'sha256': http_client.get_sha256(archive_url),
+        'dest': dest,
+    }
@@ -0,0 +1,271 @@
+__license__ = 'MIT'
+import contextlib
+import contextvars
+import hashlib
+import http.client
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import urllib.request
+
+from profiler import profiler
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlsplit
+
+CHUNK_SIZE = 1024 * 1024
+MAX_CONNECTIONS_PER_HOST = 4
+MAX_REDIRECTS = 5
+TIMEOUT = 60
+USER_AGENT = f'Python-urllib/{sys.version_info.major}.{sys.version_info.minor}'
+# Larger bodies are recorded by their digest and size only
+MAX_RECORDED_BODY = 1024 * 1024
+
+
+class ReplayError(URLError):
+    pass
+
+
+class Response:
+    def __init__(self, url: str, status: int, headers: Dict[str, str], body: BinaryIO):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.bytes_read = 0
+        self._body = body
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._body.read() if size < 0 else self._body.read(size)
+        self.bytes_read += len(data)
+
+        return data
+
+
+_HostType = Tuple[str, str]
+
+
+class HttpClient:
+    def __init__(self, max_connections_per_host: int = MAX_CONNECTIONS_PER_HOST):
+        self._max_connections_per_host = max_connections_per_host
+        self._lock = threading.Lock()
+        self._idle: Dict[_HostType, List[http.client.HTTPConnection]] = {}
+        self._slots: Dict[_HostType, threading.BoundedSemaphore] = {}
+
+    def _get_slot(self, host: _HostType) -> threading.BoundedSemaphore:
+        with self._lock:
+            return self._slots.setdefault(host, threading.BoundedSemaphore(self._max_connections_per_host))
+
+    def _request(self, host: _HostType, target: str) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        while True:
+            with self._lock:
+                idle = self._idle.get(host)
+                connection = idle.pop() if idle else None
+
+            reused = connection is not None
+
+            if connection is None:
+                scheme, netloc = host
+                connection_type = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+                connection = connection_type(netloc, timeout=TIMEOUT)
+
+            try:
+                connection.request('GET', target, headers={'User-Agent': USER_AGENT})
+
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+
+                # The server may have closed an idle connection, retry on a new one
+                if not reused:
+                    raise
+
+    def _release(self, host: _HostType, connection: http.client.HTTPConnection, response: http.client.HTTPResponse):
+        # Only a fully read response leaves the connection usable for the next request
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle.setdefault(host, []).append(connection)
+        else:
+            connection.close()
+
+    @contextlib.contextmanager
+    def open(self, url: str) -> Iterator[Response]:
+        location = url
+
+        for _ in range(MAX_REDIRECTS + 1):
+            parts = urlsplit(location)
+
+            # Other schemes and proxied requests are left to urllib
+            if parts.scheme not in ['http', 'https'] or parts.scheme in urllib.request.getproxies():
+                with urllib.request.urlopen(location) as response:
+                    yield Response(url, response.status, dict(response.headers), response)
+                return
+
+            host = (parts.scheme, parts.netloc)
+            target = f'{parts.path or "/"}?{parts.query}' if parts.query else parts.path or '/'
+
+            with self._get_slot(host):
+                connection, response = self._request(host, target)
+
+                try:
+                    if response.status in [301, 302, 303, 307, 308] and response.getheader('Location'):
+                        response.read()
+                        location = urljoin(location, response.getheader('Location'))
+                        continue
+
+                    if response.status >= 400:
+                        body = response.read()
+                        raise HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+
+                    yield Response(url, response.status, dict(response.getheaders()), response)
+                    return
+                finally:
+                    self._release(host, connection, response)
+
+        raise URLError(f'Too many redirects for {url}')
+
+    def get_sha256(self, url: str) -> Tuple[str, int]:
+        sha256 = hashlib.sha256()
+        size = 0
+
+        with self.open(url) as response:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                size += len(chunk)
+
+        return sha256.hexdigest(), size
+
+
+def _load_index(path: str) -> Dict[str, Any]:
+    if not os.path.isfile(f'{path}/index.json'):
+        return {}
+
+    with open(f'{path}/index.json', 'r') as input:
+        return json.load(input)
+
+
+class RecordingClient(HttpClient):
+    def __init__(self, path: str, client: HttpClient):
+        self._path = path
+        self._client = client
+        self._lock = threading.Lock()
+        self._index = _load_index(path)
+        os.makedirs(f'{path}/bodies', exist_ok=True)
+
+    def _record(self, response: Response, sha256: str, size: int, body: Optional[bytes]):
+        entry = {'status': response.status, 'headers': response.headers, 'sha256': sha256, 'size': size}
+
+        if body is not None:
+            with open(f'{self._path}/bodies/{sha256}', 'wb') as output:
+                output.write(body)
+
+            entry['body'] = sha256
+
+        with self._lock:
+            self._index[response.url] = entry
+
+            with open(f'{self._path}/index.json.{os.getpid()}', 'w') as output:
+                json.dump(self._index, output, indent=4, sort_keys=True)
+
+            os.replace(f'{self._path}/index.json.{os.getpid()}', f'{self._path}/index.json')
+
+    def _copy(self, response: Response, output: Optional[BinaryIO]) -> Tuple[str, int, Optional[bytes]]:
+        sha256 = hashlib.sha256()
+        body: Optional[bytearray] = bytearray()
+        size = 0
+
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            size += len(chunk)
+
+            if output is not None:
+                output.write(chunk)
+
+            if body is not None:
+                body += chunk
+
+                if len(body) > MAX_RECORDED_BODY:
+                    body = None
+
+        return sha256.hexdigest(), size, bytes(body) if body is not None else None
+
+    @contextlib.contextmanager
+    def open(self, url: str) -> Iterator[Response]:
+        with self._client.open(url) as response, tempfile.TemporaryFile() as body:
+            self._record(response, *self._copy(response, body))
+            body.seek(0)
+            yield Response(url, response.status, response.headers, body)
+
+    def get_sha256(self, url: str) -> Tuple[str, int]:
+        with self._client.open(url) as response:
+            sha256, size, body = self._copy(response, None)
+            self._record(response, sha256, size, body)
+
+        return sha256, size
+
+
+class ReplayClient(HttpClient):
+    def __init__(self, path: str):
+        self._path = path
+        self._index = _load_index(path)
+
+    def _get_entry(self, url: str) -> Dict[str, Any]:
+        if url not in self._index:
+            raise ReplayError(f'{url} was not recorded')
+
+        return self._index[url]
+
+    @contextlib.contextmanager
+    def open(self, url: str) -> Iterator[Response]:
+        entry = self._get_entry(url)
+
+        if 'body' not in entry:
+            raise ReplayError(f'Only the digest of {url} was recorded')
+
+        with open(f'{self._path}/bodies/{entry["body"]}', 'rb') as body:
+            yield Response(url, entry['status'], entry['headers'], body)
+
+    def get_sha256(self, url: str) -> Tuple[str, int]:
+        entry = self._get_entry(url)
+
+        return entry['sha256'], entry['size']
+
+
+_client: 'contextvars.ContextVar[HttpClient]' = contextvars.ContextVar('http_client', default=HttpClient())
+
+
+def use_client(client: HttpClient) -> HttpClient:
+    _client.set(client)
+
+    return client
+
+
+def start_recording(path: str) -> HttpClient:
+    return use_client(RecordingClient(path, _client.get()))
+
+
+def start_replay(path: str) -> HttpClient:
+    return use_client(ReplayClient(path))
+
+
+@contextlib.contextmanager
+def open_url(url: str) -> Iterator[Response]:
+    with profiler.span(urlsplit(url).netloc, 'http', url=url) as info, _client.get().open(url) as response:
+        try:
+            yield response
+        finally:
+            info['bytes'] = response.bytes_read
+
+
+def fetch(url: str) -> bytes:
+    with open_url(url) as response:
+        return response.read()
+
+
+def get_sha256(url: str) -> str:
+    with profiler.span(urlsplit(url).netloc, 'http', url=url) as info:
+        sha256, info['bytes'] = _client.get().get_sha256(url)
+
+    return sha256
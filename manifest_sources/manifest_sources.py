@@ -0,0 +1,128 @@
+__license__ = 'MIT'
+import json
+import os
+import shlex
+import yaml
+
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple
+
+_FlatpakSourceType = Dict[str, Any]
+
+REMOTE_TYPES = ['archive', 'file']
+ARCHES = ['x86_64', 'aarch64']
+INLINE_KEYS = {'type', 'contents', 'dest', 'dest-filename'}
+SHELL_KEYS = {'type', 'commands'}
+COMPACT_SCRIPT = '.compact-sources.sh'
+
+
+def _load(path: str) -> Any:
+    with open(path, 'r') as input:
+        if Path(path).suffix in ['.yml', '.yaml']:
+            return yaml.safe_load(input)
+        else:
+            return json.load(input)
+
+
+def _walk_module(module: Dict[str, Any], base_dir: str, files: List[str]) -> Iterator[Tuple[_FlatpakSourceType, str]]:
+    for source in module.get('sources', []):
+        if isinstance(source, str):
+            path = os.path.join(base_dir, source)
+            files.append(path)
+            sources = _load(path)
+
+            for source in sources if isinstance(sources, list) else [sources]:
+                yield source, os.path.dirname(path)
+        else:
+            yield source, base_dir
+
+    for child_module in module.get('modules', []):
+        if isinstance(child_module, str):
+            path = os.path.join(base_dir, child_module)
+            files.append(path)
+            yield from _walk_module(_load(path), os.path.dirname(path), files)
+        else:
+            yield from _walk_module(child_module, base_dir, files)
+
+
+def walk_manifest(manifest_path: str) -> Tuple[List[Tuple[_FlatpakSourceType, str]], List[str]]:
+    # Returns all sources with the directory their paths are relative to, and the files referenced
+    files = [manifest_path]
+    sources = list(_walk_module(_load(manifest_path), os.path.dirname(manifest_path), files))
+
+    return sources, files
+
+
+def get_remote_sources(manifest_path: str) -> List[_FlatpakSourceType]:
+    sources, _ = walk_manifest(manifest_path)
+
+    return [
+        source for source, _ in sources
+        if source.get('type') in REMOTE_TYPES and 'url' in source and 'sha256' in source
+    ]
+
+
+def get_local_files(manifest_path: str) -> List[str]:
+    # The manifest, the source and module files it includes and the local files of its sources
+    sources, files = walk_manifest(manifest_path)
+
+    for source, base_dir in sources:
+        paths = [source['path']] if 'path' in source else source.get('paths', [])
+        files += [os.path.join(base_dir, path) for path in paths]
+
+    return files
+
+
+def filter_arches(sources: List[_FlatpakSourceType], arches: List[str]) -> List[_FlatpakSourceType]:
+    # Drops the sources that are only used on architectures that are not selected
+    return [
+        source for source in sources
+        if not isinstance(source, dict)
+        or (set(source.get('only-arches', arches)) & set(arches) and not set(arches) <= set(source.get('skip-arches', [])))
+    ]
+
+
+def _is_compactable(source: _FlatpakSourceType) -> bool:
+    if source.get('type') == 'inline':
+        return set(source) <= INLINE_KEYS and 'dest-filename' in source and isinstance(source.get('contents'), str)
+
+    return source.get('type') == 'shell' and set(source) <= SHELL_KEYS
+
+
+def compact_sources(sources: List[_FlatpakSourceType]) -> List[_FlatpakSourceType]:
+    # Inline files and plain shell commands are folded into one script, run by a single shell command after all other sources.
+    # flatpak-builder spawns a sandbox per shell command, and the script's printf builtin has no argument length limit.
+    compacted = []
+    commands = []
+    dirs = set()
+
+    for source in sources:
+        if not _is_compactable(source):
+            compacted.append(source)
+        elif source['type'] == 'shell':
+            # Each command ran in its own shell, keep a cd from leaking into the next
+            commands += [f'({command})' for command in source['commands']]
+        else:
+            dest = source.get('dest', '.')
+            path = os.path.join(dest, source['dest-filename'])
+
+            if dest not in dirs:
+                dirs.add(dest)
+                commands.append(f'mkdir -p {shlex.quote(dest)}')
+
+            commands.append(f"printf '%s' {shlex.quote(source['contents'])} > {shlex.quote(path)}")
+
+    if commands:
+        compacted += [
+            {
+                'type': 'script',
+                'commands': ['set -e'] + commands,
+                'dest-filename': COMPACT_SCRIPT,
+            },
+            {
+                'type': 'shell',
+                'commands': [f'sh {COMPACT_SCRIPT} && rm {COMPACT_SCRIPT}'],
+            },
+        ]
+
+    return compacted
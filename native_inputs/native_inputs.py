@@ -0,0 +1,129 @@
+__license__ = 'MIT'
+import os
+import re
+import yaml
+
+from typing import Any, Dict, Iterator, List, NamedTuple, Set, Tuple
+
+PUB_CACHE = '.pub-cache'
+# Directories that don't take part in the build of a package
+SKIPPED_DIRS = {'.git', '.dart_tool', 'build', 'target', 'example', 'test', 'doc'}
+MAX_DEPTH = 4
+
+_APPLY_CARGOKIT = re.compile(r'apply_cargokit\(\s*\S+\s+"?([^\s")]+)')
+_CMAKE_DOWNLOAD = re.compile(r'\b(?:URL|DOWNLOAD)\s+"?(https?://[^\s")]+)')
+_CMAKE_FETCH = re.compile(r'\b(FetchContent_Declare|ExternalProject_Add|file\s*\(\s*DOWNLOAD)\b')
+_URL = re.compile(r'''https?://[^\s'"`)]+''')
+
+
+class Download(NamedTuple):
+    package: str
+    path: str
+    url: str
+
+
+class NativeInputs(NamedTuple):
+    extra_pubspecs: List[str]
+    cargo_locks: List[str]
+    downloads: List[Download]
+
+
+def _get_package_dir(name: str, package: Dict[str, Any], pubspec_dir: str) -> str:
+    source = package.get('source')
+    description = package.get('description', {})
+
+    if source == 'hosted':
+        return f'{PUB_CACHE}/hosted/pub.dev/{name}-{package["version"]}'
+
+    if source == 'git':
+        # The layout used by pub, see pubspec_generator
+        repo = str(description['url']).split('/')[-1].split('.git')[0]
+        return os.path.normpath(os.path.join(f'{PUB_CACHE}/git/{repo}-{description["resolved-ref"]}', description.get('path', '.')))
+
+    if source == 'path' and description.get('relative', False):
+        return os.path.normpath(os.path.join(pubspec_dir, description['path']))
+
+    return ''
+
+
+def _walk(root: str, path: str = '.', depth: int = 0) -> Iterator[Tuple[str, List[str]]]:
+    entries = sorted(os.scandir(os.path.join(root, path)), key=lambda entry: entry.name)
+    yield path, [entry.name for entry in entries if entry.is_file()]
+
+    if depth < MAX_DEPTH:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) and entry.name not in SKIPPED_DIRS:
+                yield from _walk(root, os.path.normpath(os.path.join(path, entry.name)), depth + 1)
+
+
+def _read(path: str) -> str:
+    with open(path, 'r', errors='replace') as input:
+        return input.read()
+
+
+def _scan_package(module_root: str, name: str, package_dir: str, inputs: NativeInputs):
+    full_dir = os.path.join(module_root, package_dir)
+
+    for path, files in _walk(full_dir):
+        rel_dir = os.path.normpath(os.path.join(package_dir, path))
+
+        if os.path.basename(path) == 'build_tool' and os.path.basename(os.path.dirname(path)) == 'cargokit':
+            if 'pubspec.lock' in files:
+                inputs.extra_pubspecs.append(rel_dir)
+
+        if 'Cargo.lock' in files:
+            inputs.cargo_locks.append(rel_dir)
+
+        for file in files:
+            file_path = os.path.join(full_dir, path, file)
+            is_hook = os.path.basename(path) == 'hook' and file.endswith('.dart')
+
+            if file == 'CMakeLists.txt' or file.endswith('.cmake'):
+                contents = _read(file_path)
+
+                # cargokit builds the crate in manifest_dir, relative to the CMakeLists.txt
+                for manifest_dir in _APPLY_CARGOKIT.findall(contents):
+                    crate_dir = os.path.normpath(os.path.join(rel_dir, manifest_dir))
+
+                    if os.path.isfile(os.path.join(module_root, crate_dir, 'Cargo.lock')):
+                        inputs.cargo_locks.append(crate_dir)
+
+                urls = _CMAKE_DOWNLOAD.findall(contents)
+
+                for url in urls:
+                    inputs.downloads.append(Download(name, os.path.join(rel_dir, file), url))
+
+                if not urls and _CMAKE_FETCH.search(contents):
+                    inputs.downloads.append(Download(name, os.path.join(rel_dir, file), ''))
+            elif is_hook:
+                # Native assets hooks typically download prebuilt libraries
+                urls = _URL.findall(_read(file_path))
+
+                for url in urls:
+                    inputs.downloads.append(Download(name, os.path.join(rel_dir, file), url))
+
+                if not urls:
+                    inputs.downloads.append(Download(name, os.path.join(rel_dir, file), ''))
+
+
+def discover(module_root: str, pubspec_path: str, known: Set[str]) -> NativeInputs:
+    # Paths are relative to the module root, where the pub cache lives
+    inputs = NativeInputs([], [], [])
+
+    with open(os.path.join(module_root, pubspec_path, 'pubspec.lock'), 'r') as input:
+        pubspec_lock = yaml.safe_load(input)
+
+    for name, package in (pubspec_lock.get('packages') or {}).items():
+        if name in known:
+            continue
+
+        package_dir = _get_package_dir(name, package, pubspec_path)
+
+        if package_dir and os.path.isdir(os.path.join(module_root, package_dir)):
+            _scan_package(module_root, name, package_dir, inputs)
+
+    # A Cargo.lock can be found via more than one route
+    cargo_locks = list(dict.fromkeys(inputs.cargo_locks))
+    extra_pubspecs = list(dict.fromkeys(inputs.extra_pubspecs))
+
+    return NativeInputs(extra_pubspecs, cargo_locks, list(dict.fromkeys(inputs.downloads)))
@@ -0,0 +1,122 @@
+__license__ = 'MIT'
+import contextlib
+import contextvars
+import json
+import os
+import subprocess
+import threading
+import time
+
+from typing import Any, Dict, Iterator, List
+
+
+class Profiler:
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._spans: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def record(self, name: str, category: str, start: float, end: float, args: Dict[str, Any]):
+        with self._lock:
+            self._spans.append({
+                'name': name,
+                'cat': category,
+                'start': start - self._start,
+                'duration': end - start,
+                'tid': threading.get_ident(),
+                'args': args,
+            })
+
+    def summary(self) -> Dict[str, Any]:
+        categories: Dict[str, Dict[str, Any]] = {}
+
+        with self._lock:
+            spans = list(self._spans)
+
+        for span in spans:
+            category = categories.setdefault(span['cat'], {'count': 0, 'duration': 0.0, 'spans': {}})
+            entry = category['spans'].setdefault(span['name'], {'count': 0, 'duration': 0.0})
+            category['count'] += 1
+            category['duration'] += span['duration']
+            entry['count'] += 1
+            entry['duration'] += span['duration']
+
+            if 'bytes' in span['args']:
+                category['bytes'] = category.get('bytes', 0) + span['args']['bytes']
+                entry['bytes'] = entry.get('bytes', 0) + span['args']['bytes']
+
+            if 'cache' in span['args']:
+                key = 'cache_hits' if span['args']['cache'] == 'hit' else 'cache_misses'
+                category[key] = category.get(key, 0) + 1
+                entry[key] = entry.get(key, 0) + 1
+
+        return {
+            'duration': time.perf_counter() - self._start,
+            'bytes': sum(category.get('bytes', 0) for category in categories.values()),
+            'categories': categories,
+        }
+
+    def trace(self) -> Dict[str, Any]:
+        pid = os.getpid()
+
+        with self._lock:
+            events = [
+                {
+                    'name': span['name'],
+                    'cat': span['cat'],
+                    'ph': 'X',
+                    'ts': round(span['start'] * 1e6),
+                    'dur': round(span['duration'] * 1e6),
+                    'pid': pid,
+                    'tid': span['tid'],
+                    'args': span['args'],
+                }
+                for span in self._spans
+            ]
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+_profiler: 'contextvars.ContextVar[Profiler | None]' = contextvars.ContextVar('profiler', default=None)
+
+
+def start_profiling() -> Profiler:
+    profiler = Profiler()
+    _profiler.set(profiler)
+
+    return profiler
+
+
+@contextlib.contextmanager
+def span(name: str, category: str, **args) -> Iterator[Dict[str, Any]]:
+    profiler = _profiler.get()
+    start = time.perf_counter()
+
+    try:
+        yield args
+    finally:
+        if profiler is not None:
+            profiler.record(name, category, start, time.perf_counter(), args)
+
+
+def run(name: str, command, **kwargs) -> subprocess.CompletedProcess:
+    line = ' '.join(str(word) for word in command) if isinstance(command, list) else str(command)
+
+    with span(name, 'subprocess', command=line):
+        return subprocess.run(command, **kwargs)
+
+
+def write_summary(profiler: Profiler, path: str):
+    summary = json.dumps(profiler.summary(), indent=4)
+
+    if path == '-':
+        print(summary)
+    else:
+        with open(path, 'w') as out:
+            out.write(summary)
+            out.write('\n')
+
+
+def write_trace(profiler: Profiler, path: str):
+    with open(path, 'w') as out:
+        json.dump(profiler.trace(), out)
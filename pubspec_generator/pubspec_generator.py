@@ -119,6 +119,44 @@ def generate_sources(
     return pubspec_sources, deduped
 
 
+def generate_shards(
+    shards: List[Tuple[str, List[str]]],
+) -> Tuple[List[Tuple[str, List[_FlatpakSourceType]]], int]:
+    sharded_sources = []
+    seen = set()
+    deduped = 0
+
+    for shard, pubspec_paths in shards:
+        packages = {}
+
+        for path in pubspec_paths:
+            with open(path, 'r') as stream:
+                pubspec_lock = yaml.load(stream, Loader=yaml.FullLoader)
+
+            for name in pubspec_lock['packages']:
+                package = pubspec_lock['packages'][name]
+                sources = _get_package_sources(name, package)
+
+                if sources is not None:
+                    key = json.dumps(sources, sort_keys=True)
+
+                    # A package is emitted once, in the first shard that needs it
+                    if key in seen:
+                        deduped += 1
+                    else:
+                        seen.add(key)
+                        packages[(name, str(package['version']), key)] = sources
+
+        shard_sources = []
+
+        for key in sorted(packages):
+            shard_sources += packages[key]
+
+        sharded_sources.append((shard, shard_sources))
+
+    return sharded_sources, deduped
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('pubspec_paths', help='Comma separated list of paths to pubspec.lock files')
@@ -5,96 +5,103 @@ import hashlib
 import json
 import sys
 import tomlkit
-import urllib.request
 
+from download_cache import download_cache
+from http_client import http_client
+from manifest_sources.manifest_sources import ARCHES
+from typing import List, Optional
 
-def _get_rustup_channel_entries(url: str):
+
+def _get_rustup_channel_entries(url: str, state_dir: Optional[str]):
     url_sha256 = f'{url}.sha256'
 
-    with urllib.request.urlopen(url_sha256) as response:
-        sha256 = hashlib.sha256()
-        data = response.read()
-        sha256.update(data)
-        toml_sha256 = data.decode('utf-8').split(' ')[0]
-
-        return [
-            {
-                'type': 'file',
-                'url': url,
-                'sha256': toml_sha256,
-                'dest': 'static.rust-lang.org/dist'
-            },
-            {
-                'type': 'file',
-                'url': url_sha256,
-                'sha256': sha256.hexdigest(),
-                'dest': 'static.rust-lang.org/dist'
-            }
-        ]
+    data = http_client.fetch(url_sha256)
+    sha256 = hashlib.sha256()
+    sha256.update(data)
+    toml_sha256 = data.decode('utf-8').split(' ')[0]
+
+    if state_dir is not None:
+        download_cache.store(state_dir, url_sha256, sha256.hexdigest(), data)
+
+    return [
+        {
+            'type': 'file',
+            'url': url,
+            'sha256': toml_sha256,
+            'dest': 'static.rust-lang.org/dist'
+        },
+        {
+            'type': 'file',
+            'url': url_sha256,
+            'sha256': sha256.hexdigest(),
+            'dest': 'static.rust-lang.org/dist'
+        }
+    ]
 
 
 def _get_rustup_init_entry(arch: str):
     triplet = f'{arch}-unknown-linux-gnu'
     url = f'https://static.rust-lang.org/rustup/dist/{triplet}/rustup-init'
 
-    with urllib.request.urlopen(f'{url}.sha256') as response:
-        data = response.read()
-        sha256 = data.decode('utf-8').split(' ')[0]
+    data = http_client.fetch(f'{url}.sha256')
+    sha256 = data.decode('utf-8').split(' ')[0]
 
-        return {
-            'type': 'file',
-            'only-arches': [
-                arch
-            ],
-            'url': url,
-            'sha256': sha256,
-        }
+    return {
+        'type': 'file',
+        'only-arches': [
+            arch
+        ],
+        'url': url,
+        'sha256': sha256,
+    }
 
 
-def _generate_sources(version: str):
+def _generate_sources(version: str, state_dir: Optional[str], arches: List[str]):
     packages = ['cargo', 'rust-std', 'rustc']
-    arches = ['aarch64', 'x86_64']
+    # The order of the generated sources doesn't depend on the selection
+    arches = [arch for arch in ['aarch64', 'x86_64'] if arch in arches]
     url = f'https://static.rust-lang.org/dist/channel-rust-{version}.toml'
+    data = http_client.fetch(url)
+    stable = tomlkit.loads(data.decode('utf-8'))
+    date = stable['date']
+    pkgs = stable['pkg']
+    sources = _get_rustup_channel_entries(url, state_dir)
 
-    with urllib.request.urlopen(url) as response:
-        data = response.read().decode('utf-8')
-        stable = tomlkit.loads(data)
-        date = stable['date']
-        pkgs = stable['pkg']
-        sources = _get_rustup_channel_entries(url)
+    if state_dir is not None and hashlib.sha256(data).hexdigest() == sources[0]['sha256']:
+        download_cache.store(state_dir, url, sources[0]['sha256'], data)
 
-        for arch in arches:
-            sources.append(_get_rustup_init_entry(arch))
+    for arch in arches:
+        sources.append(_get_rustup_init_entry(arch))
 
-        for package in packages:
-            if package not in pkgs:
-                continue
+    for package in packages:
+        if package not in pkgs:
+            continue
 
-            targets = pkgs[package]['target']
+        targets = pkgs[package]['target']
 
-            for arch in arches:
-                triplet = f'{arch}-unknown-linux-gnu'
+        for arch in arches:
+            triplet = f'{arch}-unknown-linux-gnu'
 
-                if triplet not in targets:
-                    continue
+            if triplet not in targets:
+                continue
 
-                details = targets[triplet]
-                sources.append(
-                    {
-                        'type': 'file',
-                        'only-arches': [
-                            arch
-                        ],
-                        'url': details['xz_url'],
-                        'sha256': details['xz_hash'],
-                        'dest': f'static.rust-lang.org/dist/{date}'
-                    }
-                )
+            details = targets[triplet]
+            sources.append(
+                {
+                    'type': 'file',
+                    'only-arches': [
+                        arch
+                    ],
+                    'url': details['xz_url'],
+                    'sha256': details['xz_hash'],
+                    'dest': f'static.rust-lang.org/dist/{date}'
+                }
+            )
 
-        return sources
+    return sources
 
 
-def generate_rustup(version: str, rustup_path: str):
+def generate_rustup(version: str, rustup_path: str, state_dir: Optional[str] = None, arches: List[str] = ARCHES):
     return {
         'name': 'rustup',
         'buildsystem': 'simple',
@@ -109,7 +116,7 @@ def generate_rustup(version: str, rustup_path: str):
             f'chmod +x rustup-init && ./rustup-init -y --default-toolchain {version} --profile minimal --no-modify-path',
             f'ln -s {rustup_path}/toolchains/{version}-${{FLATPAK_ARCH}}-unknown-linux-gnu {rustup_path}/toolchains/stable-${{FLATPAK_ARCH}}-unknown-linux-gnu'
         ],
-        'sources': _generate_sources(version)
+        'sources': _generate_sources(version, state_dir, arches)
     }
 
 
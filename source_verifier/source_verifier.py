@@ -0,0 +1,69 @@
+__license__ = 'MIT'
+import contextvars
+import json
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from http_client import http_client
+from typing import Dict, List, NamedTuple, Tuple
+
+
+class VerifyResult(NamedTuple):
+    verified: int
+    cached: int
+    mismatches: List[Tuple[str, str, str]]
+    unreachable: List[Tuple[str, str]]
+
+
+def _load_cache(cache_path: str) -> Dict[str, str]:
+    if not os.path.isfile(cache_path):
+        return {}
+
+    with open(cache_path, 'r') as input:
+        return json.load(input)
+
+
+def _save_cache(cache_path: str, cache: Dict[str, str]):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    with open(f'{cache_path}.{os.getpid()}', 'w') as output:
+        json.dump(cache, output, indent=4, sort_keys=True)
+
+    os.replace(f'{cache_path}.{os.getpid()}', cache_path)
+
+
+def verify(sources: List[Tuple[str, str]], jobs: int, cache_path: str) -> VerifyResult:
+    # Only matching checksums are cached, a failure is checked again on the next run
+    cache = _load_cache(cache_path)
+    pending = sorted(set(source for source in sources if cache.get(source[0]) != source[1]))
+    mismatches = []
+    unreachable = []
+
+    def get_sha256(url: str) -> Tuple[str, str]:
+        try:
+            return http_client.get_sha256(url), ''
+        except Exception as error:
+            return '', f'{error}'
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        # Run in a copy of the context, to keep the active HTTP client and profiler
+        futures = [executor.submit(contextvars.copy_context().run, get_sha256, url) for url, _ in pending]
+
+        for (url, expected), future in zip(pending, futures):
+            sha256, error = future.result()
+
+            if error:
+                unreachable.append((url, error))
+            elif sha256 != expected:
+                mismatches.append((url, expected, sha256))
+            else:
+                cache[url] = sha256
+
+    _save_cache(cache_path, cache)
+
+    return VerifyResult(
+        len(pending) - len(mismatches) - len(unreachable),
+        len(set(sources)) - len(pending),
+        mismatches,
+        unreachable,
+    )
@@ -0,0 +1,154 @@
+__license__ = 'MIT'
+import contextlib
+import contextvars
+import io
+import sys
+import threading
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from profiler import profiler
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, TextIO, Tuple
+
+
+class Stage(NamedTuple):
+    name: str
+    run: Callable[[Dict[str, Any]], Any]
+    depends: Tuple[str, ...] = ()
+
+
+_SinkType = Callable[[TextIO, str], None]
+
+# Where the output of the current context goes, the process streams when unset
+_sink: contextvars.ContextVar[Optional[_SinkType]] = contextvars.ContextVar('sink', default=None)
+_install_lock = threading.Lock()
+
+
+class _ContextOutput(io.TextIOBase):
+    # Installed once in place of sys.stdout and sys.stderr, it is never swapped back
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+
+    def write(self, text: str) -> int:
+        _write(self.stream, text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def fileno(self) -> int:
+        return self.stream.fileno()
+
+    def isatty(self) -> bool:
+        return self.stream.isatty()
+
+
+def _install():
+    with _install_lock:
+        if not isinstance(sys.stdout, _ContextOutput):
+            sys.stdout = _ContextOutput(sys.stdout)
+
+        if not isinstance(sys.stderr, _ContextOutput):
+            sys.stderr = _ContextOutput(sys.stderr)
+
+
+def _write(stream: TextIO, text: str):
+    sink = _sink.get()
+
+    if sink is None:
+        stream.write(text)
+        stream.flush()
+    else:
+        sink(stream, text)
+
+
+def _replay(buffer: List[Tuple[TextIO, str]]):
+    for stream, text in buffer:
+        _write(stream, text)
+
+
+@contextlib.contextmanager
+def redirect_output(write: Callable[[str], None]):
+    # Passes the lines written to stdout and stderr in this context to write, other threads and contexts are unaffected
+    pending: List[str] = []
+    lock = threading.Lock()
+
+    def sink(_: TextIO, text: str):
+        with lock:
+            lines = ''.join(pending + [text]).split('\n')
+            pending[:] = [lines.pop()]
+
+        for line in lines:
+            write(line)
+
+    _install()
+    token = _sink.set(sink)
+
+    try:
+        yield
+    finally:
+        _sink.reset(token)
+
+        if ''.join(pending):
+            write(''.join(pending))
+
+
+def run_stages(stages: List[Stage], max_workers: int) -> Dict[str, Any]:
+    names = [stage.name for stage in stages]
+
+    for stage in stages:
+        for depend in stage.depends:
+            assert depend in names[:names.index(stage.name)], f'Stage {stage.name} depends on unknown stage {depend}'
+
+    results: Dict[str, Any] = {}
+    errors: Dict[str, BaseException] = {}
+    buffers: Dict[str, List[Tuple[TextIO, str]]] = {name: [] for name in names}
+    pending = list(stages)
+    running: Dict[Future, Stage] = {}
+    flushed = 0
+
+    def run(stage: Stage) -> Any:
+        # The stage runs in a copy of the context, its output is buffered without affecting other stages
+        _sink.set(lambda stream, text: buffers[stage.name].append((stream, text)))
+
+        with profiler.span(stage.name, 'stage'):
+            return stage.run(results)
+
+    _install()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while pending or running:
+            if not errors:
+                for stage in list(pending):
+                    if all(depend in results for depend in stage.depends):
+                        pending.remove(stage)
+                        # Run in a copy of the context, to keep the active profiler
+                        running[executor.submit(contextvars.copy_context().run, run, stage)] = stage
+            else:
+                pending.clear()
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                stage = running.pop(future)
+
+                try:
+                    results[stage.name] = future.result()
+                except BaseException as error:
+                    errors[stage.name] = error
+
+            # Replay the captured output in stage order, as soon as it is complete
+            while flushed < len(names) and (names[flushed] in results or names[flushed] in errors):
+                _replay(buffers[names[flushed]])
+                flushed += 1
+
+    for name in names[flushed:]:
+        _replay(buffers[name])
+
+    for name in names:
+        if name in errors:
+            raise errors[name]
+
+    return results